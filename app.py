@@ -1,123 +1,3022 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, has_request_context, jsonify
+from flask import Response, before_render_template, send_from_directory, stream_with_context, template_rendered
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
-from functools import wraps
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from sqlalchemy import and_, case, column, event, func, literal, literal_column, or_, table, true, tuple_, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Session, joinedload
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import count, cycle, islice
+from urllib.parse import urlencode, urlsplit
+import click
+import cProfile
+import csv
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import logging
+import mimetypes
+import os
+import queue
+import random
+import re
+import secrets
+import socket
+import sqlite3
+import tempfile
+import threading
+import time as clock
+import tracemalloc
+
+try:
+    import brotli  # optional, build-assets also writes .br files when installed
+except ImportError:
+    brotli = None
+
+STARTED = clock.perf_counter()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = '@24f2000184'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///hospital.db'  # SQLite database
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///hospital.db')  # SQLite unless told otherwise
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['MAX_QUERIES_PER_REQUEST'] = None  # set in tests to catch N+1 lazy loads
+app.config['PAGE_SIZE'] = 25
+app.config['MAX_PAGE_SIZE'] = 100
+app.config['SLOT_MINUTES'] = 30
+app.config['BOOKING_WINDOW_DAYS'] = 7
+app.config['SEARCH_LIMIT'] = 50
+app.config['REFERENCE_CACHE_SIZE'] = 64
+app.config['FRAGMENT_CACHE_SIZE'] = 20000
+app.config['JINJA_CACHE_DIR'] = os.environ.get('JINJA_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+app.config['EXPORT_BATCH_SIZE'] = 1000
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 730))
+app.config['JOB_BATCH_SIZE'] = 1000
+app.config['JOB_LEASE_SECONDS'] = 15 * 60
+app.config['JOB_POLL_SECONDS'] = 60
+app.config['ROLLUP_LOOKBACK_DAYS'] = 30
+app.config['ANALYTICS_CACHE_SIZE'] = 32
+app.config['ANALYTICS_CACHE_SECONDS'] = 10 * 60
+app.config['ANALYTICS_TOP_DIAGNOSES'] = 20
+app.config['ANALYTICS_TOP_DOCTORS'] = 50
+
+# ===================== DATABASE ENGINE CONFIGURATION =====================
+
+# Applied to every new SQLite connection. WAL lets readers carry on while a booking is being
+# written, busy_timeout makes writers queue for the lock instead of failing straight away
+# with "database is locked", and NORMAL sync is safe under WAL.
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+}
+
+def engine_options(uri):
+    if uri.startswith('sqlite'):
+        return {}
+    # Postgres (or anything else with a real server): keep a warm pool per worker process
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres://'):
+    # Heroku-style URLs use a scheme SQLAlchemy no longer accepts
+    app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace('postgres://', 'postgresql://', 1)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    # busy_timeout first so switching journal_mode waits for other connections' locks too
+    for name, value in sorted(pragmas.items(), key=lambda item: item[0] != 'busy_timeout'):
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        apply_sqlite_pragmas(dbapi_connection, app.config['SQLITE_PRAGMAS'])
+
+db = SQLAlchemy(app)
+
+# ===================== DATABASE MODELS =====================
+
+class Admin(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, nullable=False)
+    password = db.Column(db.String(200), nullable=False)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+
+class Department(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    description = db.Column(db.Text)
+    doctors = db.relationship('Doctor', backref='department', lazy=True)
+
+class Doctor(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+    password = db.Column(db.String(200), nullable=False)
+    phone = db.Column(db.String(20))
+    department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False, index=True)
+    experience = db.Column(db.Integer)
+    is_active = db.Column(db.Boolean, default=True)
+    appointments = db.relationship('Appointment', backref='doctor', lazy=True)
+    availability = db.relationship('DoctorAvailability', backref='doctor', lazy=True)
+
+class Patient(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+    password = db.Column(db.String(200), nullable=False)
+    phone = db.Column(db.String(20))
+    age = db.Column(db.Integer)
+    gender = db.Column(db.String(10))
+    address = db.Column(db.Text)
+    is_active = db.Column(db.Boolean, default=True)
+    appointments = db.relationship('Appointment', backref='patient', lazy=True)
+
+class DoctorAvailability(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    is_available = db.Column(db.Boolean, default=True)
+
+    __table_args__ = (
+        db.Index('ix_availability_doctor_date', 'doctor_id', 'date'),
+    )
+
+class AvailabilityRule(db.Model):
+    # Weekly recurring window, e.g. every Monday 09:00-17:00. DoctorAvailability rows for a
+    # specific date override the rules for that day (is_available=False means day off).
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False, index=True)
+    weekday = db.Column(db.Integer, nullable=False)  # 0 = Monday ... 6 = Sunday
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    valid_from = db.Column(db.Date)
+    valid_until = db.Column(db.Date)
+
+class Appointment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time = db.Column(db.Time, nullable=False)
+    reason = db.Column(db.Text)
+    status = db.Column(db.String(20), default='Booked')  # Booked, Completed, Cancelled, NoShow
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    treatment = db.relationship('Treatment', backref='appointment', uselist=False, lazy=True)
+
+    __table_args__ = (
+        db.Index('ix_appointment_doctor_slot', 'doctor_id', 'date', 'time', 'status'),  # booking conflicts, doctor dashboard
+        db.Index('ix_appointment_patient_status_date', 'patient_id', 'status', 'date'),  # patient dashboard, history
+        db.Index('ix_appointment_status_date', 'status', 'date'),  # admin upcoming list
+        db.Index('ix_appointment_date_time', 'date', 'time'),  # admin list keyset ordering
+        db.Index('ix_appointment_patient_date_time', 'patient_id', 'date', 'time'),  # patient list keyset ordering
+        # A slot can only be held by one booked appointment; cancelled/completed rows don't count
+        db.Index('uq_appointment_booked_slot', 'doctor_id', 'date', 'time', unique=True,
+                 sqlite_where=db.text("status = 'Booked'"), postgresql_where=db.text("status = 'Booked'")),
+    )
+
+class Treatment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=False, index=True)
+    diagnosis = db.Column(db.Text)
+    prescription = db.Column(db.Text)
+    notes = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class DoctorPatient(db.Model):
+    # Roster: one row per doctor and patient who has ever booked with them (see PATIENT ROSTER)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+    last_appointment = db.Column(db.Date, nullable=False)  # latest booking, whatever became of it
+    last_visit = db.Column(db.Date)  # latest completed visit
+    visit_count = db.Column(db.Integer, nullable=False, default=0)
+    last_diagnosis = db.Column(db.Text)
+    patient = db.relationship('Patient', lazy=True)
+
+    __table_args__ = (
+        db.Index('ix_doctor_patient_doctor_last', 'doctor_id', 'last_appointment', 'patient_id'),  # roster keyset
+    )
+
+class ArchivedAppointment(db.Model):
+    # Same columns and ids as Appointment; see flask archive-appointments
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time = db.Column(db.Time, nullable=False)
+    reason = db.Column(db.Text)
+    status = db.Column(db.String(20))
+    created_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    doctor = db.relationship('Doctor', lazy=True)
+    treatment = db.relationship('ArchivedTreatment', backref='appointment', uselist=False, lazy=True)
+
+    __table_args__ = (
+        db.Index('ix_archived_appointment_patient_status_date', 'patient_id', 'status', 'date'),
+        db.Index('ix_archived_appointment_doctor_patient', 'doctor_id', 'patient_id'),
+    )
+
+class ArchivedTreatment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('archived_appointment.id'), nullable=False, index=True)
+    diagnosis = db.Column(db.Text)
+    prescription = db.Column(db.Text)
+    notes = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)
+
+class DailyRollup(db.Model):
+    # Appointments per doctor per day by status, rebuilt by the rollups job
+    date = db.Column(db.Date, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), primary_key=True)
+    department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False)
+    booked = db.Column(db.Integer, nullable=False, default=0)
+    completed = db.Column(db.Integer, nullable=False, default=0)
+    cancelled = db.Column(db.Integer, nullable=False, default=0)
+    no_show = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_daily_rollup_department_date', 'department_id', 'date'),
+    )
+
+class JobRun(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    locked_by = db.Column(db.String(100))
+    locked_until = db.Column(db.DateTime)
+    last_started_at = db.Column(db.DateTime)
+    last_success_at = db.Column(db.DateTime)
+    last_result = db.Column(db.Text)
+    last_failure_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+class Statistic(db.Model):
+    name = db.Column(db.String(80), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class CacheVersion(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+class UserSession(db.Model):
+    # Server-side half of a login; the cookie carries the id, the table only its SHA-256
+    id = db.Column(db.String(64), primary_key=True)
+    role = db.Column(db.String(20), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    revoked_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_user_session_role_user', 'role', 'user_id'),
+    )
+
+class AppointmentEvent(db.Model):
+    # Booked / cancelled / completed, read by the live boards (see LIVE APPOINTMENT EVENTS)
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    doctor_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_appointment_event_doctor_id', 'doctor_id', 'id'),
+    )
+
+class SchemaMigration(db.Model):
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# ===================== EAGER LOADING OPTIONS =====================
+
+# Relationships are lazy, so list views must say up front what their templates touch,
+# otherwise every row fires extra SELECTs for patient / doctor / department / treatment.
+def with_patient():
+    return joinedload(Appointment.patient)
+
+def with_doctor():
+    return joinedload(Appointment.doctor)
+
+def with_doctor_department():
+    return joinedload(Appointment.doctor).joinedload(Doctor.department)
+
+def with_treatment():
+    return joinedload(Appointment.treatment)
+
+# ===================== QUERY COUNT GUARD =====================
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+@app.before_request
+def reset_query_count():
+    # g outlives the request when an app context was already pushed (flask CLI commands)
+    g.query_count = 0
+
+@app.after_request
+def check_query_count(response):
+    limit = app.config.get('MAX_QUERIES_PER_REQUEST')
+    if limit is not None and g.get('query_count', 0) > limit:
+        raise AssertionError(
+            f'{request.endpoint} ran {g.query_count} queries (limit {limit}), '
+            'a relationship is probably lazy loading per row'
+        )
+    return response
+
+# ===================== REQUEST INSTRUMENTATION =====================
+
+# Off unless INSTRUMENT_REQUESTS=1, in which case nothing below is even hooked up, so a normal
+# deployment pays nothing for it. When on, every response gets a Server-Timing header
+# (SQL time and count, template render time, SQL run while rendering -- usually lazy loads --
+# and any timed() blocks such as password checks), requests slower than SLOW_REQUEST_MS are
+# logged as one JSON line with their slowest queries, and one request in PROFILE_ONE_IN is
+# run under cProfile with the stats written to PROFILE_DIR.
+
+app.config['INSTRUMENT_REQUESTS'] = os.environ.get('INSTRUMENT_REQUESTS') == '1'
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', 500))
+app.config['SLOW_REQUEST_LOG'] = os.environ.get('SLOW_REQUEST_LOG')  # file, app logger when unset
+app.config['SLOW_REQUEST_TOP_QUERIES'] = 5
+app.config['PROFILE_ONE_IN'] = int(os.environ.get('PROFILE_ONE_IN', 0))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+
+slow_request_log = app.logger.getChild('slow_requests')
+profile_counter = count(1)
+
+@contextmanager
+def timed(name):
+    timings = g.get('timings') if has_request_context() else None
+    if timings is None:
+        yield
+        return
+    started = clock.perf_counter()
+    try:
+        yield
+    finally:
+        timings['marks'][name] = timings['marks'].get(name, 0) + clock.perf_counter() - started
+
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'timings' in g:
+        conn.info.setdefault('query_started', []).append(clock.perf_counter())
+
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started or not has_request_context() or 'timings' not in g:
+        return
+    elapsed = clock.perf_counter() - started.pop()
+    timings = g.timings
+    timings['sql'] += elapsed
+    timings['queries'].append((elapsed, statement, parameters))
+    if timings['render_started'] is not None:
+        timings['render_sql'] += elapsed
+
+def start_render_timer(sender, template, context, **extra):
+    g.timings['render_started'] = clock.perf_counter()
+
+def stop_render_timer(sender, template, context, **extra):
+    timings = g.timings
+    timings['render'] += clock.perf_counter() - timings['render_started']
+    timings['render_started'] = None
+
+def start_request_timer():
+    g.timings = {'started': clock.perf_counter(), 'sql': 0.0, 'queries': [], 'render': 0.0,
+                 'render_sql': 0.0, 'render_started': None, 'marks': {}}
+    every = app.config['PROFILE_ONE_IN']
+    if every and next(profile_counter) % every == 0:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+def loggable_parameters(statement, parameters):
+    # Don't write password hashes or session keys to the log
+    if 'password' in statement and statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE'):
+        return '[redacted]'
+    if 'user_session' in statement:
+        return '[redacted]'
+    return repr(parameters)[:200]
+
+def finish_request_timer(response):
+    timings = g.pop('timings', None)
+    if timings is None:
+        return response
+    total = clock.perf_counter() - timings['started']
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+        profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], f'{clock.time() * 1000:.0f}-{request.endpoint}.prof'))
+
+    metrics = [f'db;dur={timings["sql"] * 1000:.1f};desc="{len(timings["queries"])} queries"',
+               f'render;dur={timings["render"] * 1000:.1f}',
+               f'render-db;dur={timings["render_sql"] * 1000:.1f}']
+    metrics += [f'{name};dur={elapsed * 1000:.1f}' for name, elapsed in timings['marks'].items()]
+    metrics.append(f'total;dur={total * 1000:.1f}')
+    response.headers['Server-Timing'] = ', '.join(metrics)
+
+    if total * 1000 >= app.config['SLOW_REQUEST_MS']:
+        slowest = sorted(timings['queries'], key=lambda query: query[0], reverse=True)
+        slow_request_log.warning(json.dumps({
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+            'sql_ms': round(timings['sql'] * 1000, 1),
+            'queries': len(timings['queries']),
+            'render_ms': round(timings['render'] * 1000, 1),
+            'render_sql_ms': round(timings['render_sql'] * 1000, 1),
+            'marks_ms': {name: round(elapsed * 1000, 1) for name, elapsed in timings['marks'].items()},
+            'top_queries': [
+                {'ms': round(elapsed * 1000, 2), 'sql': ' '.join(statement.split())[:500],
+                 'parameters': loggable_parameters(statement, parameters)}
+                for elapsed, statement, parameters in slowest[:app.config['SLOW_REQUEST_TOP_QUERIES']]
+            ],
+        }))
+    return response
+
+def instrument_app():
+    if app.extensions.get('request_instrumentation'):
+        return
+    app.extensions['request_instrumentation'] = True
+    event.listen(Engine, 'before_cursor_execute', start_query_timer)
+    event.listen(Engine, 'after_cursor_execute', stop_query_timer)
+    before_render_template.connect(start_render_timer, app)
+    template_rendered.connect(stop_render_timer, app)
+    app.before_request(start_request_timer)
+    app.after_request(finish_request_timer)
+    if app.config['SLOW_REQUEST_LOG']:
+        slow_request_log.addHandler(logging.FileHandler(app.config['SLOW_REQUEST_LOG']))
+        slow_request_log.propagate = False
+
+if app.config['INSTRUMENT_REQUESTS']:
+    instrument_app()
+
+# ===================== KEYSET PAGINATION =====================
+
+class KeysetPage:
+    def __init__(self, items, next_url=None, prev_url=None):
+        self.items = items
+        self.next_url = next_url
+        self.prev_url = prev_url
+
+def page_size():
+    per_page = request.args.get('per_page', type=int) or app.config['PAGE_SIZE']
+    return max(1, min(per_page, app.config['MAX_PAGE_SIZE']))
+
+def encode_cursor(row, columns):
+    values = [getattr(row, column.key) for column in columns]
+    return ','.join(v.isoformat() if hasattr(v, 'isoformat') else str(v) for v in values)
+
+def decode_cursor(cursor, columns):
+    parts = cursor.split(',')
+    if len(parts) != len(columns):
+        raise ValueError('cursor does not match ordering')
+    values = []
+    for part, column in zip(parts, columns):
+        python_type = column.type.python_type
+        if hasattr(python_type, 'fromisoformat'):
+            values.append(python_type.fromisoformat(part))
+        else:
+            values.append(python_type(part))
+    return tuple(values)
+
+def paginate_keyset(query, columns, oldest_first=False, merge=()):
+    # Newest first by the given columns (last one must be unique, e.g. id), or oldest first.
+    # Pages are fetched with a row-value comparison against the cursor instead of OFFSET,
+    # so every page costs the same no matter how deep the user has scrolled. merge takes more
+    # (query, columns) pairs with the same column names, e.g. an archive table, which are read
+    # from the same cursor and merged into one page.
+    per_page = page_size()
+    after = request.args.get('after')
+    before = request.args.get('before')
+
+    try:
+        after_key = decode_cursor(after, columns) if after else None
+        before_key = decode_cursor(before, columns) if before else None
+    except ValueError:
+        after_key = before_key = None
+
+    # Walk back from a "before" cursor in reverse order, then flip the rows
+    backward = before_key is not None
+    descending = oldest_first == backward
+    cursor = before_key if backward else after_key
+    rows = []
+    for part_query, part_columns in ((query, columns), *merge):
+        key = tuple_(*part_columns)
+        if cursor:
+            part_query = part_query.filter(key < tuple_(*cursor) if descending else key > tuple_(*cursor))
+        rows += part_query.order_by(
+            *[column.desc() if descending else column.asc() for column in part_columns]
+        ).limit(per_page + 1).all()
+    if merge:
+        rows.sort(key=lambda row: tuple(getattr(row, column.key) for column in columns), reverse=descending)
+        rows = rows[:per_page + 1]
+
+    if backward:
+        has_prev = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        has_next = True
+    else:
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_prev = after_key is not None
+
+    args = request.args.to_dict()
+    args.pop('after', None)
+    args.pop('before', None)
+    args.update(request.view_args or {})
+
+    next_url = prev_url = None
+    if items and has_next:
+        next_url = url_for(request.endpoint, after=encode_cursor(items[-1], columns), **args)
+    if items and has_prev:
+        prev_url = url_for(request.endpoint, before=encode_cursor(items[0], columns), **args)
+    return KeysetPage(items, next_url, prev_url)
+
+APPOINTMENT_ORDER = (Appointment.date, Appointment.time, Appointment.id)
+
+# ===================== SLOT ALLOCATION =====================
+
+# Each doctor-day is an int bitmap where bit i is the slot starting SLOT_MINUTES * i after
+# midnight. Availability windows set bits, booked appointments clear the bit of the slot
+# they fall in, so "what is free" is a couple of bitwise ops per doctor-day.
+
+def slot_index(t):
+    return (t.hour * 60 + t.minute) // app.config['SLOT_MINUTES']
+
+def slot_start(index):
+    return (datetime.min + timedelta(minutes=index * app.config['SLOT_MINUTES'])).time()
+
+def window_bits(start_time, end_time):
+    minutes = app.config['SLOT_MINUTES']
+    first = -(-(start_time.hour * 60 + start_time.minute) // minutes)  # first slot starting inside the window
+    last = (end_time.hour * 60 + end_time.minute) // minutes  # first slot that would run past the end
+    if last <= first:
+        return 0
+    return ((1 << last) - 1) ^ ((1 << first) - 1)
+
+def slot_times(bits):
+    times = []
+    index = 0
+    while bits:
+        if bits & 1:
+            times.append(slot_start(index))
+        bits >>= 1
+        index += 1
+    return times
+
+def scoped(statement, doctor_column, doctor_ids=None, department_id=None):
+    if doctor_ids is not None:
+        statement = statement.where(doctor_column.in_(doctor_ids))
+    if department_id is not None:
+        statement = statement.join(Doctor, Doctor.id == doctor_column).where(
+            Doctor.department_id == department_id,
+            Doctor.is_active == True
+        )
+    return statement
+
+def availability_statement(start, end, doctor_ids=None, department_id=None, with_booked=False):
+    # Weekly rules, date overrides and (optionally) booked appointment times for the range,
+    # as one UNION ALL so the whole schedule comes back in a single indexed round trip.
+    # The first SELECT fixes the column types for all three.
+    rules = scoped(db.select(
+        literal('rule').label('kind'),
+        AvailabilityRule.doctor_id,
+        AvailabilityRule.weekday,
+        literal(None, db.Date).label('date'),
+        AvailabilityRule.start_time,
+        AvailabilityRule.end_time,
+        AvailabilityRule.valid_from,
+        AvailabilityRule.valid_until,
+        literal(True, db.Boolean).label('is_available')
+    ).where(
+        or_(AvailabilityRule.valid_from == None, AvailabilityRule.valid_from <= end),
+        or_(AvailabilityRule.valid_until == None, AvailabilityRule.valid_until >= start)
+    ), AvailabilityRule.doctor_id, doctor_ids, department_id)
+
+    overrides = scoped(db.select(
+        literal('override'),
+        DoctorAvailability.doctor_id,
+        literal(None, db.Integer),
+        DoctorAvailability.date,
+        DoctorAvailability.start_time,
+        DoctorAvailability.end_time,
+        literal(None, db.Date),
+        literal(None, db.Date),
+        DoctorAvailability.is_available
+    ).where(DoctorAvailability.date.between(start, end)), DoctorAvailability.doctor_id, doctor_ids, department_id)
+
+    parts = [rules, overrides]
+    if with_booked:
+        parts.append(scoped(db.select(
+            literal('booked'),
+            Appointment.doctor_id,
+            literal(None, db.Integer),
+            Appointment.date,
+            Appointment.time,
+            literal(None, db.Time),
+            literal(None, db.Date),
+            literal(None, db.Date),
+            literal(True, db.Boolean)
+        ).where(
+            Appointment.date.between(start, end),
+            Appointment.status == 'Booked'
+        ), Appointment.doctor_id, doctor_ids, department_id))
+    return union_all(*parts)
+
+@lru_cache(maxsize=4096)
+def rule_dates(weekday, valid_from, valid_until, start, end):
+    # Dates in [start, end] a weekly rule applies to. Rules rarely change and every page
+    # asks about the same week, so the expansion is memoised on the rule's own values.
+    first = max(start, valid_from) if valid_from else start
+    last = min(end, valid_until) if valid_until else end
+    day = first + timedelta(days=(weekday - first.weekday()) % 7)
+    dates = []
+    while day <= last:
+        dates.append(day)
+        day += timedelta(days=7)
+    return tuple(dates)
+
+def expand_schedule(rows, start, end):
+    # -> windows {(doctor_id, date): [(start_time, end_time), ...]}, booked {(doctor_id, date): [time, ...]}
+    windows, overrides, booked = {}, {}, {}
+    for row in rows:
+        if row.kind == 'rule':
+            for day in rule_dates(row.weekday, row.valid_from, row.valid_until, start, end):
+                windows.setdefault((row.doctor_id, day), []).append((row.start_time, row.end_time))
+        elif row.kind == 'override':
+            window = (row.start_time, row.end_time) if row.is_available else None
+            overrides.setdefault((row.doctor_id, row.date), []).append(window)
+        else:
+            booked.setdefault((row.doctor_id, row.date), []).append(row.start_time)
+
+    # A date override replaces whatever the weekly rules say about that day
+    for key, day_windows in overrides.items():
+        day_windows = [window for window in day_windows if window]
+        if day_windows:
+            windows[key] = day_windows
+        else:
+            windows.pop(key, None)
+    return windows, booked
+
+def availability_windows(doctor_ids, start, end):
+    windows, _ = expand_schedule(db.session.execute(availability_statement(start, end, doctor_ids)).all(), start, end)
+    return windows
+
+def schedule_slots(start, end, doctor_ids=None, department_id=None):
+    rows = db.session.execute(availability_statement(start, end, doctor_ids, department_id, with_booked=True)).all()
+    return free_slot_bitmaps(*expand_schedule(rows, start, end))
+
+def free_slot_bitmaps(windows, booked):
+    # Past days and slots that have already started today can't be booked any more
+    now = datetime.now()
+    started = (1 << -(-(now.hour * 60 + now.minute) // app.config['SLOT_MINUTES'])) - 1
+
+    bitmaps = {}
+    for (doctor_id, day), day_windows in windows.items():
+        if day < now.date():
+            continue
+        bits = 0
+        for start_time, end_time in day_windows:
+            bits |= window_bits(start_time, end_time)
+        for booked_time in booked.get((doctor_id, day), ()):
+            bits &= ~(1 << slot_index(booked_time))
+        if day == now.date():
+            bits &= ~started
+        if bits:
+            bitmaps[(doctor_id, day)] = bits
+    return bitmaps
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def booking_window(start=None):
+    start = start or datetime.now().date()
+    return start, start + timedelta(days=app.config['BOOKING_WINDOW_DAYS'])
+
+def free_slots(doctor_ids, start=None, end=None):
+    # {doctor_id: {date: [time, ...]}} for every doctor that has a free slot in range
+    if end is None:
+        start, end = booking_window(start)
+    slots = {}
+    for (doctor_id, day), bits in sorted(schedule_slots(start, end, doctor_ids=doctor_ids).items()):
+        slots.setdefault(doctor_id, {})[day] = slot_times(bits)
+    return slots
+
+def first_free_slot(department_id, start=None, end=None):
+    # Earliest (date, time, doctor_id) free in the department, from a single round trip
+    if end is None:
+        start, end = booking_window(start)
+    best = None
+    for (doctor_id, day), bits in schedule_slots(start, end, department_id=department_id).items():
+        lowest = (bits & -bits).bit_length() - 1
+        candidate = (day, slot_start(lowest), doctor_id)
+        if best is None or candidate < best:
+            best = candidate
+    return best
+
+# ===================== FULL TEXT SEARCH =====================
+
+def fts_match(text, fields):
+    # Every word the user typed must prefix-match a word in one of the fields
+    terms = re.findall(r'\w+', text)
+    if not terms:
+        return None
+    return '{%s} : (%s)' % (' '.join(fields), ' '.join(f'"{term}"*' for term in terms))
+
+def text_search(query, model, text, fields):
+    # Best matches first, capped at SEARCH_LIMIT. Falls back to LIKE on databases without FTS5.
+    if db.engine.dialect.name != 'sqlite':
+        return query.filter(or_(*[getattr(model, field).contains(text) for field in fields])).limit(
+            app.config['SEARCH_LIMIT'])
+
+    match = fts_match(text, fields)
+    if match is None:
+        return query.filter(db.false())
+
+    index = table(f'{model.__tablename__}_search', column('rowid'), column('rank'))
+    return query.join(index, index.c.rowid == model.id).filter(
+        literal_column(index.name).op('MATCH')(match)
+    ).order_by(index.c.rank).limit(app.config['SEARCH_LIMIT'])
+
+# ===================== DASHBOARD STATISTICS =====================
+
+# Dashboard counters live in the statistic table and are bumped in the same transaction as
+# the write that changes them, so dashboards read a handful of rows instead of running
+# COUNT(*) over the whole history. Keys:
+#   active_doctors, active_patients, total_appointments
+#   booked:<YYYY-MM-DD>       booked appointments on that day (upcoming = sum from today)
+#   doctor_patients:<id>      distinct patients a doctor has had appointments with
+
+def booked_stat(day):
+    return f'booked:{day.isoformat()}'
+
+def doctor_patients_stat(doctor_id):
+    return f'doctor_patients:{doctor_id}'
+
+# INSERT ... ON CONFLICT DO UPDATE for the dialects that have it, so two requests bumping a
+# counter that doesn't exist yet can't both try to insert it
+UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+def increment_row(executor, model, name, column, delta, **values):
+    dialect = getattr(executor, 'dialect', None) or executor.get_bind().dialect
+    insert = UPSERT_INSERTS.get(dialect.name)
+    if insert is None:
+        updated = executor.execute(
+            db.update(model).where(model.name == name).values({column: getattr(model, column) + delta, **values})
+        ).rowcount
+        if not updated:
+            executor.execute(db.insert(model).values({'name': name, column: delta, **values}))
+        return
+    statement = insert(model).values({'name': name, column: delta, **values})
+    executor.execute(statement.on_conflict_do_update(
+        index_elements=[model.name],
+        set_={column: getattr(model, column) + statement.excluded[column], **values}
+    ))
+
+def bump_stat(name, delta=1, connection=None):
+    increment_row(db.session if connection is None else connection, Statistic, name, 'value', delta)
+
+def get_stats(*names):
+    values = dict(db.session.query(Statistic.name, Statistic.value).filter(Statistic.name.in_(names)).all())
+    return [values.get(name, 0) for name in names]
+
+def upcoming_booked_count(today):
+    # booked:<date> keys sort by date, so this is a short primary key range read
+    return db.session.query(func.coalesce(func.sum(Statistic.value), 0)).filter(
+        Statistic.name >= booked_stat(today),
+        Statistic.name < 'booked;'
+    ).scalar()
+
+def compute_stats(connection):
+    doctor, patient, appointment = Doctor.__table__, Patient.__table__, Appointment.__table__
+    archived = ArchivedAppointment.__table__
+    stats = {
+        'active_doctors': connection.execute(
+            db.select(func.count()).select_from(doctor).where(doctor.c.is_active == True)).scalar(),
+        'active_patients': connection.execute(
+            db.select(func.count()).select_from(patient).where(patient.c.is_active == True)).scalar(),
+        'total_appointments': connection.execute(
+            db.select(func.count()).select_from(appointment)).scalar() + connection.execute(
+            db.select(func.count()).select_from(archived)).scalar(),
+    }
+    for day, count in connection.execute(
+        db.select(appointment.c.date, func.count()).where(appointment.c.status == 'Booked').group_by(appointment.c.date)
+    ):
+        stats[booked_stat(day)] = count
+    visits = union_all(
+        db.select(appointment.c.doctor_id, appointment.c.patient_id),
+        db.select(archived.c.doctor_id, archived.c.patient_id)
+    ).subquery()
+    for doctor_id, count in connection.execute(
+        db.select(visits.c.doctor_id, func.count(visits.c.patient_id.distinct())).group_by(visits.c.doctor_id)
+    ):
+        stats[doctor_patients_stat(doctor_id)] = count
+    return stats
+
+def write_stats(connection, stats):
+    connection.execute(db.delete(Statistic.__table__))
+    if stats:
+        connection.execute(db.insert(Statistic.__table__), [
+            {'name': name, 'value': value} for name, value in stats.items()
+        ])
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    with db.engine.begin() as connection:
+        stats = compute_stats(connection)
+        write_stats(connection, stats)
+    print(f"Rebuilt {len(stats)} statistics")
+
+@app.cli.command('verify-stats')
+def verify_stats_command():
+    with db.engine.connect() as connection:
+        expected = compute_stats(connection)
+        stored = dict(connection.execute(db.select(Statistic.name, Statistic.value)).all())
+    mismatches = [
+        (name, stored.get(name, 0), expected.get(name, 0))
+        for name in sorted(set(expected) | set(stored))
+        if stored.get(name, 0) != expected.get(name, 0)
+    ]
+    for name, have, want in mismatches:
+        print(f"MISMATCH {name}: stored {have}, actual {want}")
+    if mismatches:
+        raise SystemExit(1)
+    print(f"All {len(expected)} statistics match")
+
+# ===================== PATIENT ROSTER =====================
+
+# doctor_patient holds, per doctor, every patient who has booked with them: date of the latest
+# booking, number of completed visits, date and diagnosis of the latest one. book_slot and
+# complete_appointment keep it current in the same transaction, so the dashboard roster is a
+# keyset range read over (doctor_id, last_appointment, patient_id) instead of a DISTINCT over
+# every appointment. Archiving doesn't touch it. rebuild-roster recomputes it from the live
+# and archived appointments.
+
+ROSTER_ORDER = (DoctorPatient.last_appointment, DoctorPatient.patient_id)
+
+def roster_booked(doctor_id, patient_id, date):
+    # True when this is the first appointment the patient has booked with this doctor
+    roster = DoctorPatient.__table__
+    updated = db.session.execute(db.update(roster).where(
+        roster.c.doctor_id == doctor_id, roster.c.patient_id == patient_id
+    ).values(last_appointment=case((roster.c.last_appointment < date, date), else_=roster.c.last_appointment))).rowcount
+    if not updated:
+        db.session.execute(db.insert(roster).values(doctor_id=doctor_id, patient_id=patient_id,
+                                                    last_appointment=date, visit_count=0))
+    return not updated
+
+def roster_completed(doctor_id, patient_id, date, diagnosis):
+    roster = DoctorPatient.__table__
+    latest = or_(roster.c.last_visit.is_(None), roster.c.last_visit <= date)
+    updated = db.session.execute(db.update(roster).where(
+        roster.c.doctor_id == doctor_id, roster.c.patient_id == patient_id
+    ).values(
+        visit_count=roster.c.visit_count + 1,
+        last_visit=case((latest, date), else_=roster.c.last_visit),
+        last_diagnosis=case((latest, diagnosis), else_=roster.c.last_diagnosis),
+    )).rowcount
+    if not updated:
+        db.session.execute(db.insert(roster).values(doctor_id=doctor_id, patient_id=patient_id, last_appointment=date,
+                                                    last_visit=date, visit_count=1, last_diagnosis=diagnosis))
+
+def rebuild_roster(connection):
+    appointment, treatment = Appointment.__table__, Treatment.__table__
+    archived, archived_treatment = ArchivedAppointment.__table__, ArchivedTreatment.__table__
+    visits = union_all(*[
+        db.select(a.c.doctor_id, a.c.patient_id, a.c.date, a.c.time, a.c.status, t.c.diagnosis)
+        .select_from(a.outerjoin(t, t.c.appointment_id == a.c.id))
+        for a, t in ((appointment, treatment), (archived, archived_treatment))
+    ]).subquery()
+    completed = visits.c.status == 'Completed'
+    summary = db.select(
+        visits.c.doctor_id, visits.c.patient_id,
+        func.max(visits.c.date).label('last_appointment'),
+        func.max(case((completed, visits.c.date))).label('last_visit'),
+        func.count(case((completed, 1))).label('visit_count'),
+    ).group_by(visits.c.doctor_id, visits.c.patient_id).subquery()
+    ranked = db.select(visits.c.doctor_id, visits.c.patient_id, visits.c.diagnosis, func.row_number().over(
+        partition_by=(visits.c.doctor_id, visits.c.patient_id), order_by=(visits.c.date.desc(), visits.c.time.desc())
+    ).label('n')).where(completed).subquery()
+    rows = db.select(summary, ranked.c.diagnosis).select_from(summary.outerjoin(ranked, and_(
+        ranked.c.doctor_id == summary.c.doctor_id, ranked.c.patient_id == summary.c.patient_id, ranked.c.n == 1)))
+
+    roster = DoctorPatient.__table__
+    connection.execute(db.delete(roster))
+    connection.execute(db.insert(roster).from_select(
+        ['doctor_id', 'patient_id', 'last_appointment', 'last_visit', 'visit_count', 'last_diagnosis'], rows))
+    return connection.execute(db.select(func.count()).select_from(roster)).scalar()
+
+@app.cli.command('rebuild-roster')
+def rebuild_roster_command():
+    with db.engine.begin() as connection:
+        print(f"Rebuilt roster with {rebuild_roster(connection)} doctor-patient rows")
+
+# ===================== BOOKING =====================
+
+def book_slot(patient_id, doctor_id, date, time, reason=None):
+    # Insert straight away and let uq_appointment_booked_slot decide who gets the slot.
+    # Returns None when another booking already holds it.
+    appointment = Appointment(patient_id=patient_id, doctor_id=doctor_id, date=date, time=time, reason=reason)
+    db.session.add(appointment)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+
+    bump_stat('total_appointments')
+    bump_stat(booked_stat(date))
+    if roster_booked(doctor_id, patient_id, date):
+        bump_stat(doctor_patients_stat(doctor_id))
+    touch_schedule(doctor_id, patient_id)
+    appointment_event('booked', appointment)
+    db.session.commit()
+    return appointment
+
+# ===================== REFERENCE DATA CACHE =====================
+
+# Departments and the active doctor directory change a few times a month but are read on
+# almost every patient page. They are cached per process as plain dicts, tagged with the
+# 'directory' version stamp from the cache_version table. Any worker that changes a doctor
+# bumps the stamp in the same transaction, and every worker checks it once per request,
+# so stale entries are dropped everywhere on the next request.
+
+class ReferenceCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version, load):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = load()
+        with self.lock:
+            self.entries[key] = (version, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def discard(self, match):
+        # Drop the entries whose (key, value) match, e.g. every cached session of one account
+        with self.lock:
+            for key in [key for key, (version, value) in self.entries.items() if match(key, value)]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses}
+
+reference_cache = ReferenceCache(app.config['REFERENCE_CACHE_SIZE'])
+
+def directory_version():
+    if 'directory_version' not in g:
+        g.directory_version = db.session.query(CacheVersion.version).filter_by(name='directory').scalar() or 0
+    return g.directory_version
+
+def bump_version(name, connection=None):
+    increment_row(db.session if connection is None else connection, CacheVersion, name, 'version', 1,
+                  updated_at=datetime.utcnow())
+
+def bump_directory_version(connection=None):
+    bump_version('directory', connection)
+    g.pop('directory_version', None)
+
+def department_dict(department):
+    return {'id': department.id, 'name': department.name, 'description': department.description}
+
+def doctor_dict(doctor):
+    return {
+        'id': doctor.id,
+        'name': doctor.name,
+        'email': doctor.email,
+        'phone': doctor.phone,
+        'experience': doctor.experience,
+        'is_active': doctor.is_active,
+        'department_id': doctor.department_id,
+        'department': department_dict(doctor.department),
+    }
+
+def cached_departments():
+    return reference_cache.get(('departments',), directory_version(), lambda: [
+        department_dict(department) for department in Department.query.order_by(Department.id).all()
+    ])
+
+def cached_doctors(department_id=None):
+    # Active doctors, optionally for one department, with their department preloaded
+    def load():
+        query = Doctor.query.options(joinedload(Doctor.department)).filter_by(is_active=True)
+        if department_id is not None:
+            query = query.filter_by(department_id=department_id)
+        return [doctor_dict(doctor) for doctor in query.order_by(Doctor.id).all()]
+    return reference_cache.get(('doctors', department_id), directory_version(), load)
+
+# ===================== TEMPLATE CACHING =====================
+
+# Doctor cards (patient_doctors) and rows with their edit modal (admin_doctors) only change
+# when a doctor or department does, so each one is rendered once and kept as HTML, tagged
+# with the same 'directory' version as the reference cache. add/edit/delete_doctor and the
+# doctor import bump that version, which drops every stale fragment on the next request.
+#
+# Compiled templates are also kept on disk (JINJA_CACHE_DIR), so a freshly started worker
+# loads bytecode instead of parsing and compiling every template again.
+
+fragment_cache = ReferenceCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+@app.template_global()
+def cached_fragment(template_name, key, **context):
+    def render():
+        return Markup(app.jinja_env.get_template(template_name).render(**context))
+    return fragment_cache.get((template_name, key), directory_version(), render)
+
+if app.config['JINJA_CACHE_DIR']:
+    os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR'])
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    # Fill the bytecode cache ahead of time, e.g. while building a release
+    started = clock.perf_counter()
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    print(f"Loaded {len(names)} templates in {(clock.perf_counter() - started) * 1000:.1f} ms")
+
+# ===================== STATIC ASSETS =====================
+
+# flask build-assets copies every file under static/ to static/dist/ with a content hash in its
+# name (css/base.css -> css/base.<hash>.css), next to .gz and, when the optional brotli package
+# is installed, .br copies of the text files, and records the mapping in dist/manifest.json.
+# Templates link static files with asset_url(), which takes the same arguments as url_for()
+# and points at the hashed copy under /assets/ once a build exists (plain /static/ otherwise,
+# and always in debug mode so edits show up). /assets/ picks the precompressed copy the
+# browser accepts and marks it immutable for a year: a changed file gets a new name, so
+# browsers never revalidate. COMPRESS_HTML=1 also gzips rendered pages above
+# COMPRESS_MIN_BYTES, for deployments without a compressing proxy in front.
+
+app.config['ASSET_DIR'] = os.path.join(app.static_folder, 'dist')
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 60 * 60
+app.config['ASSET_COMPRESSIBLE'] = ('.css', '.js', '.json', '.map', '.svg', '.txt', '.html')
+app.config['COMPRESS_HTML'] = os.environ.get('COMPRESS_HTML') == '1'
+app.config['COMPRESS_MIN_BYTES'] = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+app.config['COMPRESS_LEVEL'] = 6
+
+asset_manifest_cache = {}
+
+def asset_manifest():
+    if 'entries' not in asset_manifest_cache:
+        try:
+            with open(os.path.join(app.config['ASSET_DIR'], 'manifest.json')) as f:
+                asset_manifest_cache['entries'] = json.load(f)
+        except FileNotFoundError:
+            asset_manifest_cache['entries'] = {}
+    return asset_manifest_cache['entries']
+
+@app.template_global()
+def asset_url(endpoint, **values):
+    if endpoint == 'static' and not app.debug:
+        hashed = asset_manifest().get(values.get('filename'))
+        if hashed:
+            return url_for('asset', **dict(values, filename=hashed))
+    return url_for(endpoint, **values)
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        path = safe_join(app.config['ASSET_DIR'], filename + suffix)
+        if request.accept_encodings[encoding] and path and os.path.isfile(path):
+            response = send_from_directory(app.config['ASSET_DIR'], filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(app.config['ASSET_DIR'], filename, mimetype=mimetype)
+    response.headers['Cache-Control'] = f"public, max-age={app.config['ASSET_MAX_AGE']}, immutable"
+    response.vary.add('Accept-Encoding')
+    return response
+
+def fingerprinted(filename, data):
+    root, extension = os.path.splitext(filename)
+    return f'{root}.{hashlib.sha256(data).hexdigest()[:12]}{extension}'
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+@app.cli.command('build-assets')
+@click.option('--prune', is_flag=True, help='Delete hashed files from earlier builds.')
+def build_assets_command(prune):
+    source, target = app.static_folder, app.config['ASSET_DIR']
+    manifest, written = {}, set()
+    sizes = Counter()
+    for directory, subdirectories, filenames in os.walk(source):
+        if os.path.abspath(directory) == os.path.abspath(source):
+            subdirectories[:] = [d for d in subdirectories if os.path.join(directory, d) != target]
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, source).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            hashed = fingerprinted(name, data)
+            manifest[name] = hashed
+            variants = {hashed: data}
+            if os.path.splitext(name)[1] in app.config['ASSET_COMPRESSIBLE']:
+                variants[hashed + '.gz'] = gzip.compress(data, 9, mtime=0)
+                if brotli is not None:
+                    variants[hashed + '.br'] = brotli.compress(data, quality=11)
+            for variant, content in variants.items():
+                if variant != hashed and len(content) >= len(data):
+                    continue
+                destination = os.path.join(target, variant)
+                if not os.path.exists(destination):
+                    write_file(destination, content)
+                written.add(os.path.normpath(destination))
+                sizes[os.path.splitext(variant)[1] if variant != hashed else 'raw'] += len(content)
+
+    write_file(os.path.join(target, 'manifest.json'), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    if prune:
+        for directory, _, filenames in os.walk(target):
+            for filename in filenames:
+                path = os.path.normpath(os.path.join(directory, filename))
+                if path not in written and filename != 'manifest.json':
+                    os.remove(path)
+    print(f"Built {len(manifest)} assets: {sizes['raw']} bytes, {sizes['.gz']} gzip, "
+          f"{sizes['.br'] if brotli is not None else 'no'} brotli{'' if brotli is not None else ' (pip install brotli)'}")
+
+def compress_html(response):
+    if response.mimetype != 'text/html' or response.is_streamed or response.direct_passthrough:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or 'Content-Encoding' in response.headers or not request.accept_encodings['gzip']:
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_BYTES']:
+        return response
+    response.set_data(gzip.compress(data, app.config['COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+if app.config['COMPRESS_HTML']:
+    app.after_request(compress_html)
+
+# ===================== CHANGE COUNTERS =====================
+
+# Every write that changes what a doctor or patient would see (their appointments, a
+# doctor's hours) bumps 'doctor:<id>' / 'patient:<id>' in cache_version in the same
+# transaction. The JSON API turns these into ETags, so a poll that finds the counter
+# unchanged answers 304 after one primary key read.
+
+def doctor_version_name(doctor_id):
+    return f'doctor:{doctor_id}'
+
+def patient_version_name(patient_id):
+    return f'patient:{patient_id}'
+
+def touch_schedule(doctor_id=None, patient_id=None, connection=None):
+    if doctor_id is not None:
+        bump_version(doctor_version_name(doctor_id), connection)
+    if patient_id is not None:
+        bump_version(patient_version_name(patient_id), connection)
+
+def change_version(name):
+    # -> (version, updated_at); (0, None) for something that never changed
+    row = db.session.query(CacheVersion.version, CacheVersion.updated_at).filter_by(name=name).first()
+    return (row.version, row.updated_at) if row else (0, None)
+
+# ===================== DECORATORS FOR LOGIN REQUIRED =====================
+
+def login_required(role):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if 'user_id' not in session or session.get('role') != role:
+                flash('Please login first', 'danger')
+                return redirect(url_for('login'))
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+def api_login_required(*roles):
+    # JSON clients get a status code instead of a redirect to the login page
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if 'user_id' not in session:
+                return jsonify(error='login required'), 401
+            if session.get('role') not in roles:
+                return jsonify(error='forbidden'), 403
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+# ===================== PASSWORD HASHING & LOGIN ADMISSION =====================
+
+# New and changed passwords are hashed with PASSWORD_HASH_METHOD (any werkzeug method string,
+# e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000). A successful login whose stored hash used
+# other parameters is rehashed on the spot, so raising the cost upgrades accounts as people
+# sign in.
+#
+# Hashing is deliberately expensive, so a crowd logging in at once could take every CPU.
+# Verification runs on a pool of PASSWORD_WORKERS threads per process (hashlib releases the
+# GIL while hashing) with at most PASSWORD_QUEUE more logins waiting; beyond that the login
+# is turned away with 503 straight away instead of queueing behind the others. An account
+# tried from one client address, and a client address overall, get 429 before any hashing
+# once they have too many recent failures. The account limit is per address so that someone
+# guessing at a doctor's or admin's login can't lock the real user out of it.
+# All of this is per process, like the reference cache.
+
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_SALT_LENGTH'] = 16
+app.config['PASSWORD_WORKERS'] = int(os.environ.get('PASSWORD_WORKERS', 2))
+app.config['PASSWORD_QUEUE'] = int(os.environ.get('PASSWORD_QUEUE', 8))
+app.config['LOGIN_WINDOW_SECONDS'] = 15 * 60
+app.config['LOGIN_FAILURES_PER_ACCOUNT'] = int(os.environ.get('LOGIN_FAILURES_PER_ACCOUNT', 10))
+app.config['LOGIN_FAILURES_PER_IP'] = int(os.environ.get('LOGIN_FAILURES_PER_IP', 100))
+app.config['LOGIN_TRACKED_KEYS'] = 10000
+
+ACCOUNT_MODELS = {'admin': Admin, 'doctor': Doctor, 'patient': Patient}
+
+def hash_password(password):
+    return generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'],
+                                  salt_length=app.config['PASSWORD_SALT_LENGTH'])
+
+@lru_cache(maxsize=8)
+def hash_parameters(method):
+    # 'scrypt' and 'scrypt:32768:8:1' are the same thing; compare what werkzeug actually writes
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+def password_outdated(hashed):
+    return hashed.split('$', 1)[0] != hash_parameters(app.config['PASSWORD_HASH_METHOD'])
+
+class LoginBusy(Exception):
+    pass
+
+password_pool = ThreadPoolExecutor(max_workers=app.config['PASSWORD_WORKERS'], thread_name_prefix='password')
+password_slots = threading.BoundedSemaphore(app.config['PASSWORD_WORKERS'] + app.config['PASSWORD_QUEUE'])
+
+@contextmanager
+def password_slot():
+    if not password_slots.acquire(blocking=False):
+        raise LoginBusy()
+    try:
+        with timed('password'):
+            yield
+    finally:
+        password_slots.release()
+
+def verify_password(hashed, password):
+    return password_pool.submit(check_password_hash, hashed, password).result()
+
+class FailureCounter:
+    # Failure times per key within a sliding window; least recently failed keys are dropped
+    def __init__(self, limit, window, max_keys):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.failures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def recent(self, key, now):
+        times = self.failures.get(key)
+        while times and times[0] <= now - self.window:
+            times.popleft()
+        return times
+
+    def blocked(self, key):
+        with self.lock:
+            times = self.recent(key, clock.monotonic())
+            return bool(times) and len(times) >= self.limit
+
+    def record(self, key):
+        now = clock.monotonic()
+        with self.lock:
+            times = self.recent(key, now)
+            if times is None:
+                times = self.failures[key] = deque()
+            times.append(now)
+            self.failures.move_to_end(key)
+            while len(self.failures) > self.max_keys:
+                self.failures.popitem(last=False)
+
+    def clear(self, key):
+        with self.lock:
+            self.failures.pop(key, None)
+
+account_failures = FailureCounter(app.config['LOGIN_FAILURES_PER_ACCOUNT'], app.config['LOGIN_WINDOW_SECONDS'],
+                                  app.config['LOGIN_TRACKED_KEYS'])
+address_failures = FailureCounter(app.config['LOGIN_FAILURES_PER_IP'], app.config['LOGIN_WINDOW_SECONDS'],
+                                  app.config['LOGIN_TRACKED_KEYS'])
+
+# Behind nginx or a load balancer remote_addr is the proxy, which would put every client in
+# one per-IP bucket. With TRUSTED_PROXIES=n the client address (and scheme) come from the
+# X-Forwarded-For/-Proto entries added by the last n proxies. Leave it at 0 when clients
+# reach gunicorn directly, otherwise they can pick their own address by sending the header.
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
+
+def find_account(email, role):
+    # One query over all three account tables; the same email may exist under several roles
+    branches = [
+        db.select(literal(name).label('role'), model.id, model.password,
+                  (model.username if model is Admin else model.name).label('name'),
+                  (literal(True) if model is Admin else model.is_active).label('is_active'))
+        .where(model.email == email)
+        for name, model in ACCOUNT_MODELS.items()
+    ]
+    accounts = db.session.execute(union_all(*branches)).all()
+    matching = [account for account in accounts if account.role == role]
+    if matching:
+        return matching[0]
+    return accounts[0] if len(accounts) == 1 and not role else None
+
+def check_login(account, password):
+    with password_slot():
+        if not verify_password(account.password, password):
+            return False
+        if password_outdated(account.password):
+            hashed = password_pool.submit(hash_password, password).result()
+            model = ACCOUNT_MODELS[account.role]
+            db.session.execute(db.update(model).where(model.id == account.id).values(password=hashed))
+            db.session.commit()
+    return True
+
+@app.cli.command('password-methods')
+def password_methods_command():
+    # How many stored hashes still use old parameters (they are upgraded at the next login)
+    current = hash_parameters(app.config['PASSWORD_HASH_METHOD'])
+    for name, model in ACCOUNT_MODELS.items():
+        methods = Counter(hashed.split('$', 1)[0] for hashed, in db.session.query(model.password))
+        for method, number in methods.most_common():
+            print(f"{name:8} {method:30} {number:8d}{'' if method == current else '  outdated'}")
+
+# ===================== SERVER-SIDE SESSIONS =====================
+
+# Logging in creates a user_session row and the signed cookie only carries its id ('sid').
+# The row is keyed by session_key(sid), a SHA-256 of the id, so the table (and any query
+# parameters that end up in a log) can't be replayed as a cookie.
+# Every request resolves the id to the logged-in principal (role, id, name, active) through a
+# per-process LRU, so normally no query runs. Revoking a session (logout, account deactivated)
+# or renaming an account bumps a per-account 'session:<role>:<id>' version stamp plus the
+# global 'sessions' stamp. The process making the change evicts the affected entries right
+# away; other workers re-read the global stamp at most every SESSION_CHECK_SECONDS and, when
+# it moved, evict only the sessions of accounts whose stamp changed since their last look.
+# A cookie whose session is gone, expired or belongs to an inactive account is cleared before
+# the view runs, so login_required turns it away.
+
+app.config['SESSION_LIFETIME_HOURS'] = int(os.environ.get('SESSION_LIFETIME_HOURS', 12))
+app.config['SESSION_CACHE_SIZE'] = 10000
+app.config['SESSION_CHECK_SECONDS'] = float(os.environ.get('SESSION_CHECK_SECONDS', 2))
+
+# Stamps are written with the app's clock before commit, so look a bit further back than the
+# last seen change to catch slow transactions and clock skew between hosts
+SESSION_CHANGE_OVERLAP = timedelta(minutes=1)
+
+session_cache = ReferenceCache(app.config['SESSION_CACHE_SIZE'])
+session_changes = {'version': None, 'updated_at': None, 'checked': None}
+
+def principal_key(role, user_id):
+    return f'session:{role}:{user_id}'
+
+def forget_principals(keys):
+    session_cache.discard(lambda sid, principal: principal is not None
+                          and principal_key(principal['role'], principal['user_id']) in keys)
+
+def check_session_changes():
+    now = clock.monotonic()
+    checked = session_changes['checked']
+    if checked is not None and now - checked < app.config['SESSION_CHECK_SECONDS']:
+        return
+    session_changes['checked'] = now
+    row = db.session.query(CacheVersion.version, CacheVersion.updated_at).filter_by(name='sessions').first()
+    version, updated_at = row or (0, None)
+    if version == session_changes['version']:
+        return
+    if session_changes['version'] is not None:
+        changed = db.session.query(CacheVersion.name).filter(
+            CacheVersion.name >= 'session:', CacheVersion.name < 'session;')
+        if session_changes['updated_at'] is not None:
+            changed = changed.filter(CacheVersion.updated_at >= session_changes['updated_at'] - SESSION_CHANGE_OVERLAP)
+        forget_principals({name for name, in changed})
+    session_changes['version'], session_changes['updated_at'] = version, updated_at
+
+def sessions_changed(role, user_id):
+    # Call in the transaction that revokes or renames; this process re-checks on its next request
+    bump_version('sessions')
+    bump_version(principal_key(role, user_id))
+    forget_principals({principal_key(role, user_id)})
+    session_changes['checked'] = None
+
+def session_key(sid):
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+def load_principal(sid):
+    user_session = db.session.get(UserSession, session_key(sid))
+    if user_session is None or user_session.revoked_at is not None:
+        return None
+    user = db.session.get(ACCOUNT_MODELS[user_session.role], user_session.user_id)
+    if user is None or not getattr(user, 'is_active', True):
+        return None
+    return {'user_id': user.id, 'role': user_session.role, 'expires_at': user_session.expires_at,
+            'name': user.username if user_session.role == 'admin' else user.name}
+
+def start_session(role, user_id):
+    sid = secrets.token_urlsafe(32)
+    db.session.add(UserSession(id=session_key(sid), role=role, user_id=user_id,
+                               expires_at=datetime.utcnow() + timedelta(hours=app.config['SESSION_LIFETIME_HOURS'])))
+    db.session.commit()
+    return sid
+
+def end_session(sid):
+    user_session = db.session.get(UserSession, session_key(sid))
+    if user_session is not None and user_session.revoked_at is None:
+        user_session.revoked_at = datetime.utcnow()
+        # Only this login goes from the local cache; other workers drop the account's sessions
+        bump_version('sessions')
+        bump_version(principal_key(user_session.role, user_session.user_id))
+        db.session.commit()
+    session_cache.discard(lambda key, principal: key == sid)
+
+def revoke_sessions(role, user_id):
+    db.session.execute(db.update(UserSession).where(
+        UserSession.role == role, UserSession.user_id == user_id, UserSession.revoked_at.is_(None)
+    ).values(revoked_at=datetime.utcnow()))
+    sessions_changed(role, user_id)
+
+@app.before_request
+def check_session():
+    if request.endpoint in ('static', 'asset'):
+        return
+    sid = session.get('sid')
+    if sid is None:
+        if 'user_id' in session:
+            session.clear()  # cookie from before server-side sessions
+        return
+    check_session_changes()
+    principal = session_cache.get(sid, 0, lambda: load_principal(sid))
+    if principal is None or principal['expires_at'] <= datetime.utcnow():
+        session.clear()
+        return
+    if session.get('name') != principal['name']:
+        session['name'] = principal['name']
+
+# ===================== SCHEMA MIGRATIONS =====================
+
+# db.create_all() only creates missing tables, it never touches tables that already exist
+# in hospital.db. Anything that changes an existing table (indexes, columns) goes here as a
+# numbered step. Steps must be idempotent because a fresh database already gets the
+# current schema from create_all().
+
+def create_indexes(connection, model, *names):
+    # Name the indexes explicitly: a step must keep doing the same thing after later
+    # releases add more indexes to the model
+    for index in model.__table__.indexes:
+        if index.name in names:
+            index.create(connection, checkfirst=True)
+
+def migration_001_hot_query_indexes(connection):
+    create_indexes(connection, Appointment, 'ix_appointment_doctor_slot', 'ix_appointment_patient_status_date',
+                   'ix_appointment_status_date', 'ix_appointment_date_time')
+    create_indexes(connection, DoctorAvailability, 'ix_availability_doctor_date')
+    create_indexes(connection, Treatment, 'ix_treatment_appointment_id')
+
+def migration_002_doctor_department_index(connection):
+    create_indexes(connection, Doctor, 'ix_doctor_department_id')
+
+# FTS5 external-content indexes over doctor / patient contact fields. Triggers keep them in
+# step with every insert, update and delete, whichever code path writes the row.
+SEARCH_INDEXES = {
+    'doctor': ('name', 'email', 'phone'),
+    'patient': ('name', 'email', 'phone'),
+}
+
+def migration_003_search_indexes(connection):
+    if connection.dialect.name != 'sqlite':
+        return
+    for source, fields in SEARCH_INDEXES.items():
+        index = f'{source}_search'
+        field_list = ', '.join(fields)
+        new_values = ', '.join(f'new.{field}' for field in fields)
+        old_values = ', '.join(f'old.{field}' for field in fields)
+        connection.exec_driver_sql(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5("
+            f"{field_list}, content='{source}', content_rowid='id')"
+        )
+        connection.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {source} BEGIN "
+            f"INSERT INTO {index}(rowid, {field_list}) VALUES (new.id, {new_values}); END"
+        )
+        connection.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {source} BEGIN "
+            f"INSERT INTO {index}({index}, rowid, {field_list}) VALUES ('delete', old.id, {old_values}); END"
+        )
+        connection.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {field_list} ON {source} BEGIN "
+            f"INSERT INTO {index}({index}, rowid, {field_list}) VALUES ('delete', old.id, {old_values}); "
+            f"INSERT INTO {index}(rowid, {field_list}) VALUES (new.id, {new_values}); END"
+        )
+        connection.exec_driver_sql(f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+
+def migration_004_dashboard_statistics(connection):
+    write_stats(connection, compute_stats(connection))
+
+def migration_005_unique_booked_slot(connection):
+    # Earlier releases could double book a slot. Keep the first booking of each slot,
+    # cancel the rest, then let the database enforce it from now on.
+    appointment = Appointment.__table__
+    first = db.select(func.min(appointment.c.id)).where(appointment.c.status == 'Booked').group_by(
+        appointment.c.doctor_id, appointment.c.date, appointment.c.time)
+    cancelled = connection.execute(
+        db.update(appointment).where(appointment.c.status == 'Booked', appointment.c.id.not_in(first)).values(
+            status='Cancelled')
+    ).rowcount
+    if cancelled:
+        print(f"Cancelled {cancelled} double booked appointments")
+        write_stats(connection, compute_stats(connection))
+    create_indexes(connection, Appointment, 'uq_appointment_booked_slot')
+
+def add_column(connection, model, name):
+    table = model.__table__
+    if name in {c['name'] for c in db.inspect(connection).get_columns(table.name)}:
+        return
+    column = table.c[name]
+    connection.exec_driver_sql(
+        f'ALTER TABLE {table.name} ADD COLUMN {name} {column.type.compile(dialect=connection.dialect)}'
+    )
+
+def migration_006_change_timestamps(connection):
+    add_column(connection, CacheVersion, 'updated_at')
+
+def migration_007_user_sessions(connection):
+    UserSession.__table__.create(connection, checkfirst=True)
+
+def migration_008_patient_roster(connection):
+    DoctorPatient.__table__.create(connection, checkfirst=True)
+    rebuild_roster(connection)
+
+def migration_009_appointment_events(connection):
+    AppointmentEvent.__table__.create(connection, checkfirst=True)
+
+def migration_010_patient_appointment_order(connection):
+    create_indexes(connection, Appointment, 'ix_appointment_patient_date_time')
+
+def migration_011_hashed_session_keys(connection):
+    # Rows from before this step are keyed by the cookie value itself
+    user_session = UserSession.__table__
+    for sid, in connection.execute(db.select(user_session.c.id)).all():
+        connection.execute(db.update(user_session).where(user_session.c.id == sid).values(id=session_key(sid)))
+
+MIGRATIONS = [
+    (1, 'Composite indexes for appointment, availability and treatment lookups', migration_001_hot_query_indexes),
+    (2, 'Index doctors by department for slot search', migration_002_doctor_department_index),
+    (3, 'Full text search over doctor and patient name, email and phone', migration_003_search_indexes),
+    (4, 'Seed dashboard statistics from existing rows', migration_004_dashboard_statistics),
+    (5, 'One booked appointment per doctor slot', migration_005_unique_booked_slot),
+    (6, 'Record when change counters were last bumped', migration_006_change_timestamps),
+    (7, 'Server-side login sessions', migration_007_user_sessions),
+    (8, 'Doctor-patient roster', migration_008_patient_roster),
+    (9, 'Appointment events for the live boards', migration_009_appointment_events),
+    (10, 'Index patient appointments in list order', migration_010_patient_appointment_order),
+    (11, 'Key login sessions by a hash of the cookie value', migration_011_hashed_session_keys),
+]
+
+def migrate_db():
+    applied = {m.version for m in SchemaMigration.query.all()}
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        with db.engine.begin() as connection:
+            migrate(connection)
+        db.session.add(SchemaMigration(version=version, description=description))
+        db.session.commit()
+        print(f"Applied migration {version}: {description}")
+
+def schema_version():
+    with db.engine.connect() as connection:
+        return connection.execute(db.select(func.max(SchemaMigration.version))).scalar()
+
+# Processes that only use the database (web workers, run-jobs) refuse to start on an old
+# schema instead of migrating it themselves and racing each other on DDL
+def check_schema():
+    try:
+        version = schema_version()
+    except OperationalError:
+        version = None
+    if version != MIGRATIONS[-1][0]:
+        raise RuntimeError(f'Database schema is at version {version}, expected {MIGRATIONS[-1][0]}; '
+                           'run "flask --app app init-db" first')
+    return version
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    db.create_all()
+    migrate_db()
+
+# ===================== QUERY PLAN CHECK =====================
+
+# Representative versions of the queries the routes run. check-indexes asks SQLite for the
+# plan of each one and fails if any of them falls back to a full table scan, or has to sort
+# every matching row before returning the first (a keyset page without an index in its order).
+def hot_queries():
+    today = datetime.now().date()
+    now = datetime.now().time()
+    return {
+        'book_appointment conflict check': Appointment.query.filter_by(
+            doctor_id=1, date=today, time=now, status='Booked'),
+        'doctor_dashboard upcoming': Appointment.query.filter(
+            Appointment.doctor_id == 1,
+            Appointment.date.between(today, today + timedelta(days=7)),
+            Appointment.status == 'Booked'
+        ).order_by(*APPOINTMENT_ORDER).limit(100),
+        'patient_dashboard upcoming': Appointment.query.filter(
+            Appointment.patient_id == 1,
+            Appointment.date >= today,
+            Appointment.status == 'Booked'
+        ).order_by(Appointment.date, Appointment.time),
+        'treatment_history page': Appointment.query.options(
+            with_doctor_department(), with_treatment()
+        ).filter_by(patient_id=1, status='Completed').order_by(
+            *[column.desc() for column in APPOINTMENT_ORDER]).limit(26),
+        'admin_upcoming_appointments page': Appointment.query.filter(
+            Appointment.date >= today,
+            Appointment.status == 'Booked'
+        ).order_by(*APPOINTMENT_ORDER).limit(26),
+        'admin_appointments page': Appointment.query.order_by(
+            *[column.desc() for column in APPOINTMENT_ORDER]).limit(26),
+        'doctor_appointments page': Appointment.query.filter_by(doctor_id=1).order_by(
+            *[column.desc() for column in APPOINTMENT_ORDER]).limit(26),
+        'patient_appointments page': Appointment.query.filter_by(patient_id=1).order_by(
+            *[column.desc() for column in APPOINTMENT_ORDER]).limit(26),
+        'doctor_availability': DoctorAvailability.query.filter(
+            DoctorAvailability.doctor_id == 1,
+            DoctorAvailability.date >= today
+        ).order_by(DoctorAvailability.date),
+        'treatment by appointment': Treatment.query.filter_by(appointment_id=1),
+        'doctor roster page': DoctorPatient.query.filter(DoctorPatient.doctor_id == 1).order_by(
+            *[column.desc() for column in ROSTER_ORDER]).limit(26),
+        'free slots for a doctor': availability_statement(
+            today, today + timedelta(days=7), doctor_ids=[1], with_booked=True),
+        'first free slot in department': availability_statement(
+            today, today + timedelta(days=7), department_id=1, with_booked=True),
+    }
+
+def explain_query_plan(query):
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(db.engine, compile_kwargs={'render_postcompile': True})
+    params = [compiled.params[name] for name in compiled.positiontup]
+    params = [p.isoformat() if hasattr(p, 'isoformat') else p for p in params]
+    with db.engine.connect() as connection:
+        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), tuple(params)).all()
+    return [row[-1] for row in rows]
+
+def full_scans(plan):
+    return [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step]
+
+def full_sorts(plan):
+    # 'FOR RIGHT PART OF ORDER BY' only sorts rows that tie on the indexed columns
+    return [step for step in plan if step == 'USE TEMP B-TREE FOR ORDER BY']
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    failed = False
+    for name, query in hot_queries().items():
+        plan = explain_query_plan(query)
+        scans = full_scans(plan) + full_sorts(plan)
+        print(f"{'FAIL' if scans else 'ok  '} {name}: {' | '.join(plan)}")
+        failed = failed or bool(scans)
+    if failed:
+        raise SystemExit(1)
+
+# ===================== INITIALIZE DATABASE & ADMIN =====================
+
+def init_db():
+    with app.app_context():
+        db.create_all()
+        migrate_db()
+        
+        # Create admin if doesn't exist
+        if not Admin.query.first():
+            admin = Admin(
+                username='admin',
+                email='admin@hospital.com',
+                password=hash_password('admin123')
+            )
+            db.session.add(admin)
+            db.session.commit()
+            print("Admin created - Username: admin, Password: admin123")
+        
+        # Create sample departments if none exist
+        if not Department.query.first():
+            departments = [
+                Department(name='Cardiology', description='Heart and cardiovascular system'),
+                Department(name='Neurology', description='Brain and nervous system'),
+                Department(name='Orthopedics', description='Bones and joints'),
+                Department(name='Pediatrics', description='Children health'),
+                Department(name='Dermatology', description='Skin conditions')
+            ]
+            db.session.add_all(departments)
+            db.session.commit()
+            print("Sample departments created")
+
+# One-shot setup for production: run once per deploy, before starting the workers
+@app.cli.command('init-db')
+def init_db_command():
+    init_db()
+    with app.app_context():
+        print(f"Database ready at schema version {schema_version()}")
+
+# ===================== BULK IMPORT =====================
+
+# flask import-patients / import-doctors / import-availability FILE.csv
+#
+# The CSV is streamed in chunks of --batch-size rows. Each chunk is validated, its
+# passwords are hashed across a process pool, and the good rows are inserted with one
+# executemany in a single transaction (together with the dashboard counter update).
+# After every committed chunk the number of rows consumed is written to FILE.csv.progress,
+# so re-running the same command after a crash resumes where it stopped. Rejected rows are
+# appended to FILE.csv.errors.csv with the reason.
+
+class RowError(ValueError):
+    pass
+
+def required(row, field):
+    value = (row.get(field) or '').strip()
+    if not value:
+        raise RowError(f'{field} is required')
+    return value
+
+def optional_int(row, field):
+    value = (row.get(field) or '').strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise RowError(f'{field} must be a whole number')
+
+def clean_person(row):
+    email = required(row, 'email')
+    if '@' not in email:
+        raise RowError('email is not valid')
+    return {
+        'name': required(row, 'name'),
+        'email': email,
+        'password': required(row, 'password'),
+        'phone': (row.get('phone') or '').strip() or None,
+        'is_active': True,
+    }
+
+def clean_patient(row, lookups):
+    patient = clean_person(row)
+    patient.update(
+        age=optional_int(row, 'age'),
+        gender=(row.get('gender') or '').strip() or None,
+        address=(row.get('address') or '').strip() or None,
+    )
+    return patient
+
+def clean_doctor(row, lookups):
+    doctor = clean_person(row)
+    department = required(row, 'department')
+    department_id = lookups['departments'].get(department.lower())
+    if department_id is None:
+        raise RowError(f'unknown department {department}')
+    doctor.update(department_id=department_id, experience=optional_int(row, 'experience'))
+    return doctor
+
+def clean_availability(row, lookups):
+    day, start, end = required(row, 'date'), required(row, 'start_time'), required(row, 'end_time')
+    try:
+        day = datetime.strptime(day, '%Y-%m-%d').date()
+        start_time = datetime.strptime(start, '%H:%M').time()
+        end_time = datetime.strptime(end, '%H:%M').time()
+    except ValueError:
+        raise RowError('date must be YYYY-MM-DD and times HH:MM')
+    if end_time <= start_time:
+        raise RowError('end_time must be after start_time')
+    return {'doctor_email': required(row, 'doctor_email'), 'date': day,
+            'start_time': start_time, 'end_time': end_time, 'is_available': True}
+
+def hash_passwords(rows, pool):
+    passwords = [row['password'] for row in rows]
+    hashes = pool.map(hash_password, passwords, chunksize=64) if pool else map(hash_password, passwords)
+    for row, hashed in zip(rows, hashes):
+        row['password'] = hashed
+
+def insert_people(model, stat, rows, pool, connection):
+    # Drop emails that already exist (earlier chunks, earlier runs) or repeat within the chunk
+    table = model.__table__
+    existing = {email for email, in connection.execute(
+        db.select(table.c.email).where(table.c.email.in_([row['email'] for _, row in rows]))
+    )}
+    accepted, rejected = [], []
+    for number, row in rows:
+        if row['email'] in existing:
+            rejected.append((number, 'email already exists'))
+        else:
+            existing.add(row['email'])
+            accepted.append(row)
+
+    hash_passwords(accepted, pool)
+    if accepted:
+        connection.execute(db.insert(table), accepted)
+        bump_stat(stat, len(accepted), connection=connection)
+    return len(accepted), rejected
+
+def insert_patients(rows, pool, connection):
+    return insert_people(Patient, 'active_patients', rows, pool, connection)
+
+def insert_doctors(rows, pool, connection):
+    imported, rejected = insert_people(Doctor, 'active_doctors', rows, pool, connection)
+    if imported:
+        bump_directory_version(connection)
+    return imported, rejected
+
+def insert_availability(rows, pool, connection):
+    doctors = dict(connection.execute(
+        db.select(Doctor.__table__.c.email, Doctor.__table__.c.id).where(
+            Doctor.__table__.c.email.in_({row['doctor_email'] for _, row in rows}))
+    ).all())
+    availability = DoctorAvailability.__table__
+    windows, rejected = {}, []
+    for number, row in rows:
+        doctor_id = doctors.get(row.pop('doctor_email'))
+        if doctor_id is None:
+            rejected.append((number, 'unknown doctor_email'))
+            continue
+        row['doctor_id'] = doctor_id
+        windows[(doctor_id, row['date'])] = row  # later rows for the same doctor-day win, like the form
+
+    # Same upsert as the availability form: one window per doctor-day
+    existing = set(connection.execute(
+        db.select(availability.c.doctor_id, availability.c.date).where(
+            tuple_(availability.c.doctor_id, availability.c.date).in_(list(windows)))
+    ).all()) if windows else set()
+    updates = [
+        {'key_doctor_id': key[0], 'key_date': key[1], 'new_start': row['start_time'], 'new_end': row['end_time']}
+        for key, row in windows.items() if key in existing
+    ]
+    inserts = [row for key, row in windows.items() if key not in existing]
+    if inserts:
+        connection.execute(db.insert(availability), inserts)
+    if updates:
+        connection.execute(
+            db.update(availability).where(
+                availability.c.doctor_id == db.bindparam('key_doctor_id'),
+                availability.c.date == db.bindparam('key_date')
+            ).values(start_time=db.bindparam('new_start'), end_time=db.bindparam('new_end'), is_available=True),
+            updates
+        )
+    for doctor_id in {doctor_id for doctor_id, _ in windows}:
+        touch_schedule(doctor_id, connection=connection)
+    return len(inserts) + len(updates), rejected
+
+def import_lookups():
+    return {'departments': {
+        key: department.id
+        for department in Department.query.all()
+        for key in (department.name.lower(), str(department.id))
+    }}
+
+def check_header(path, columns):
+    with open(path, newline='', encoding='utf-8') as source:
+        fieldnames = csv.DictReader(source).fieldnames
+    if not fieldnames:
+        raise click.ClickException(f'{path} is empty, expected a header row')
+    missing = [column for column in columns if column not in fieldnames]
+    if missing:
+        raise click.ClickException(f"{path} is missing required columns: {', '.join(missing)}")
+
+def run_import(path, clean, insert, batch_size, workers):
+    progress_path = path + '.progress'
+    errors_path = path + '.errors.csv'
+    done = 0
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            done = int(f.read().strip() or 0)
+        print(f"Resuming {path} after row {done}")
+
+    lookups = import_lookups()
+    imported = rejected = 0
+    pool = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    try:
+        with open(path, newline='', encoding='utf-8') as source, \
+                open(errors_path, 'a' if done else 'w', newline='', encoding='utf-8') as errors_file:
+            reader = csv.DictReader(source)
+            errors = csv.writer(errors_file)
+            if not done:
+                errors.writerow(['row', 'error'] + reader.fieldnames)
+            rows = enumerate(islice(reader, done, None), start=done + 1)
+
+            while True:
+                chunk = list(islice(rows, batch_size))
+                if not chunk:
+                    break
+                valid, bad = [], []
+                for number, row in chunk:
+                    try:
+                        valid.append((number, clean(row, lookups)))
+                    except RowError as e:
+                        bad.append((number, str(e)))
+
+                with db.engine.begin() as connection:
+                    count, refused = insert(valid, pool, connection) if valid else (0, [])
+
+                originals = dict(chunk)
+                for number, reason in sorted(bad + refused):
+                    errors.writerow([number, reason] + [originals[number].get(f) for f in reader.fieldnames])
+                errors_file.flush()
+
+                done = chunk[-1][0]
+                with open(progress_path, 'w') as f:
+                    f.write(str(done))
+                imported += count
+                rejected += len(bad) + len(refused)
+                print(f"{path}: {done} rows read, {imported} imported, {rejected} rejected")
+    finally:
+        if pool:
+            pool.shutdown()
+
+    if os.path.exists(progress_path):  # not written when the file has no data rows
+        os.remove(progress_path)
+    print(f"Finished {path}: {imported} imported, {rejected} rejected" +
+          (f" (see {errors_path})" if rejected else ''))
+
+def import_command(name, clean, insert, columns, required_columns):
+    @app.cli.command(name, help=f'Bulk import a CSV with columns: {columns}')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--batch-size', default=1000, show_default=True, help='Rows per transaction.')
+    @click.option('--workers', default=os.cpu_count(), show_default=True, help='Password hashing processes.')
+    def command(path, batch_size, workers):
+        check_header(path, required_columns)
+        run_import(path, clean, insert, batch_size, workers)
+    return command
+
+import_command('import-patients', clean_patient, insert_patients,
+               'name, email, password, phone, age, gender, address',
+               ('name', 'email', 'password'))
+import_command('import-doctors', clean_doctor, insert_doctors,
+               'name, email, password, phone, department (name or id), experience',
+               ('name', 'email', 'password', 'department'))
+import_command('import-availability', clean_availability, insert_availability,
+               'doctor_email, date (YYYY-MM-DD), start_time (HH:MM), end_time (HH:MM)',
+               ('doctor_email', 'date', 'start_time', 'end_time'))
+
+# ===================== APPOINTMENT EXPORT =====================
+
+# Appointments joined with patient, doctor, department and treatment, streamed row by row.
+# yield_per makes the driver fetch EXPORT_BATCH_SIZE rows at a time instead of buffering
+# the whole result, and the writers hand out text as they go, so memory stays flat and the
+# first bytes leave before the query has finished.
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def export_statement(start=None, end=None, status=None):
+    statement = db.select(
+        Appointment.id.label('appointment_id'),
+        Appointment.date,
+        Appointment.time,
+        Appointment.status,
+        Appointment.reason,
+        Appointment.created_at,
+        Patient.id.label('patient_id'),
+        Patient.name.label('patient_name'),
+        Patient.email.label('patient_email'),
+        Doctor.id.label('doctor_id'),
+        Doctor.name.label('doctor_name'),
+        Department.name.label('department'),
+        Treatment.diagnosis,
+        Treatment.prescription,
+        Treatment.notes
+    ).join(Patient, Patient.id == Appointment.patient_id).join(
+        Doctor, Doctor.id == Appointment.doctor_id
+    ).join(
+        Department, Department.id == Doctor.department_id
+    ).outerjoin(Treatment, Treatment.appointment_id == Appointment.id)
+
+    if start:
+        statement = statement.where(Appointment.date >= start)
+    if end:
+        statement = statement.where(Appointment.date <= end)
+    if status:
+        statement = statement.where(Appointment.status == status)
+    return statement.order_by(*APPOINTMENT_ORDER).execution_options(yield_per=app.config['EXPORT_BATCH_SIZE'])
+
+def parse_export_filters(start, end, status):
+    start = datetime.strptime(start, '%Y-%m-%d').date() if start else None
+    end = datetime.strptime(end, '%Y-%m-%d').date() if end else None
+    if status and status not in ('Booked', 'Completed', 'Cancelled', 'NoShow'):
+        raise ValueError(f'unknown status {status}')
+    return start, end, status or None
+
+def export_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+def export_chunks(result, fmt):
+    columns = list(result.keys())
+    batch_size = app.config['EXPORT_BATCH_SIZE']
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(columns)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    for rows in result.partitions(batch_size):
+        for row in rows:
+            values = [export_value(value) for value in row]
+            if fmt == 'csv':
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(columns, values)), separators=(',', ':')))
+                buffer.write('\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+@app.cli.command('export-appointments')
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='csv', show_default=True)
+@click.option('--start', help='First appointment date (YYYY-MM-DD).')
+@click.option('--end', help='Last appointment date (YYYY-MM-DD).')
+@click.option('--status', help='Booked, Completed, Cancelled or NoShow.')
+@click.option('--output', type=click.File('w'), default='-', help='File to write, stdout by default.')
+def export_appointments_command(fmt, start, end, status, output):
+    try:
+        filters = parse_export_filters(start, end, status)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    with db.engine.connect() as connection:
+        for chunk in export_chunks(connection.execute(export_statement(*filters)), fmt):
+            output.write(chunk)
+
+# ===================== APPOINTMENT ARCHIVE =====================
+
+# flask archive-appointments moves Completed, Cancelled and NoShow appointments older than
+# ARCHIVE_AFTER_DAYS, with their treatments, into archived_appointment / archived_treatment.
+# Each batch is copied and deleted in one transaction, so a row is always in exactly one of
+# the two tables and the job can be stopped and re-run at any time. Archived appointments
+# keep their id. The dashboard totals count both tables; patient_history and
+# treatment_history only read the archive when the user asks for older history.
+
+ARCHIVE_STATUSES = ('Completed', 'Cancelled', 'NoShow')
+
+def archive_batch(connection, cutoff, batch_size):
+    appointment, treatment = Appointment.__table__, Treatment.__table__
+    archived_appointment, archived_treatment = ArchivedAppointment.__table__, ArchivedTreatment.__table__
+
+    # SQLite hands out max(rowid) + 1, so deleting the newest row would let its id come
+    # back; leaving it in place keeps ids unique across the hot and archive tables
+    newest = db.select(func.max(appointment.c.id)).scalar_subquery()
+    rows = connection.execute(
+        db.select(appointment.c.id, appointment.c.doctor_id, appointment.c.patient_id).where(
+            appointment.c.status.in_(ARCHIVE_STATUSES),
+            appointment.c.date < cutoff,
+            appointment.c.id < newest
+        ).order_by(appointment.c.id).limit(batch_size)
+    ).all()
+    if not rows:
+        return 0
+    ids = [row.id for row in rows]
+    archived_at = literal(datetime.utcnow(), db.DateTime)
+
+    columns = [c.name for c in appointment.columns]
+    connection.execute(db.insert(archived_appointment).from_select(
+        columns + ['archived_at'],
+        db.select(*[appointment.c[name] for name in columns], archived_at).where(appointment.c.id.in_(ids))
+    ))
+    columns = [c.name for c in treatment.columns if c.name != 'id']
+    connection.execute(db.insert(archived_treatment).from_select(
+        columns,
+        db.select(*[treatment.c[name] for name in columns]).where(treatment.c.appointment_id.in_(ids))
+    ))
+    connection.execute(db.delete(treatment).where(treatment.c.appointment_id.in_(ids)))
+    connection.execute(db.delete(appointment).where(appointment.c.id.in_(ids)))
+
+    for doctor_id in {row.doctor_id for row in rows}:
+        touch_schedule(doctor_id=doctor_id, connection=connection)
+    for patient_id in {row.patient_id for row in rows}:
+        touch_schedule(patient_id=patient_id, connection=connection)
+    return len(ids)
+
+def archive_appointments(cutoff, batch_size):
+    archived = 0
+    while True:
+        with db.engine.begin() as connection:
+            moved = archive_batch(connection, cutoff, batch_size)
+        if not moved:
+            return archived
+        archived += moved
+        renew_job_lease()
+
+ARCHIVED_ORDER = (ArchivedAppointment.date, ArchivedAppointment.time, ArchivedAppointment.id)
+
+def history_page(query, patient_id, include_archive):
+    # Completed visits newest first, one page at a time, plus the archived ones when asked for
+    merge = ()
+    if include_archive:
+        archived = ArchivedAppointment.query.options(
+            joinedload(ArchivedAppointment.doctor).joinedload(Doctor.department),
+            joinedload(ArchivedAppointment.treatment)
+        ).filter_by(patient_id=patient_id, status='Completed')
+        merge = [(archived, ARCHIVED_ORDER)]
+    return paginate_keyset(query, APPOINTMENT_ORDER, merge=merge)
+
+@app.cli.command('archive-appointments')
+@click.option('--older-than-days', type=int, help='Defaults to ARCHIVE_AFTER_DAYS.')
+@click.option('--batch-size', default=1000, show_default=True, help='Appointments per transaction.')
+def archive_appointments_command(older_than_days, batch_size):
+    days = older_than_days if older_than_days is not None else app.config['ARCHIVE_AFTER_DAYS']
+    cutoff = datetime.now().date() - timedelta(days=days)
+    archived = archive_appointments(cutoff, batch_size)
+    print(f"Archived {archived} appointments from before {cutoff.isoformat()}")
+
+# ===================== BATCH JOBS =====================
+
+# flask run-jobs runs the housekeeping jobs below outside the request path, either once
+# (from cron) or as a long-running worker with --loop. A job runs when its interval has
+# passed since its last success. Before starting, a worker takes the job's lease in
+# job_run with a conditional UPDATE, so however many workers run, each job runs in at most
+# one of them at a time. The same UPDATE re-checks that the job is still due, so two cron
+# runs that overlap don't run it back to back. Every job works in batches of JOB_BATCH_SIZE,
+# one short transaction each, and extends its lease after each batch, so a long first run
+# (say archiving years of appointments) keeps it. A worker that dies only blocks the job
+# until its lease expires.
+
+def job_no_shows():
+    # Bookings from before today that were never completed or cancelled
+    appointment = Appointment.__table__
+    today = datetime.now().date()
+    marked = 0
+    while True:
+        with db.engine.begin() as connection:
+            batch = db.select(appointment.c.id).where(
+                appointment.c.status == 'Booked', appointment.c.date < today
+            ).order_by(appointment.c.id).limit(app.config['JOB_BATCH_SIZE'])
+            rows = connection.execute(
+                db.update(appointment).where(appointment.c.id.in_(batch), appointment.c.status == 'Booked').values(
+                    status='NoShow'
+                ).returning(appointment.c.date, appointment.c.doctor_id, appointment.c.patient_id)
+            ).all()
+            if not rows:
+                return f'marked {marked} no-shows'
+            for day, missed in Counter(row.date for row in rows).items():
+                bump_stat(booked_stat(day), -missed, connection=connection)
+            for doctor_id in {row.doctor_id for row in rows}:
+                touch_schedule(doctor_id=doctor_id, connection=connection)
+            for patient_id in {row.patient_id for row in rows}:
+                touch_schedule(patient_id=patient_id, connection=connection)
+        marked += len(rows)
+        renew_job_lease()
+
+def job_rollups():
+    # Statuses keep changing after the day (completions, no-shows), so recompute a window
+    appointment, doctor, rollup = Appointment.__table__, Doctor.__table__, DailyRollup.__table__
+    today = datetime.now().date()
+    start = today - timedelta(days=app.config['ROLLUP_LOOKBACK_DAYS'])
+    end = today + timedelta(days=app.config['BOOKING_WINDOW_DAYS'])
+
+    def status_count(status):
+        return func.sum(db.case((appointment.c.status == status, 1), else_=0))
+
+    with db.engine.begin() as connection:
+        connection.execute(db.delete(rollup).where(rollup.c.date.between(start, end)))
+        written = connection.execute(db.insert(rollup).from_select(
+            ['date', 'doctor_id', 'department_id', 'booked', 'completed', 'cancelled', 'no_show'],
+            db.select(
+                appointment.c.date, appointment.c.doctor_id, doctor.c.department_id,
+                status_count('Booked'), status_count('Completed'), status_count('Cancelled'), status_count('NoShow')
+            ).select_from(appointment.join(doctor, doctor.c.id == appointment.c.doctor_id)).where(
+                appointment.c.date.between(start, end)
+            ).group_by(appointment.c.date, appointment.c.doctor_id, doctor.c.department_id)
+        )).rowcount
+    return f'{written} rollup rows for {start.isoformat()} to {end.isoformat()}'
+
+def job_prune_availability():
+    # Date overrides in the past and weekly rules that have ended never affect a slot again
+    availability, rule = DoctorAvailability.__table__, AvailabilityRule.__table__
+    today = datetime.now().date()
+    pruned = 0
+    while True:
+        with db.engine.begin() as connection:
+            batch = db.select(availability.c.id).where(availability.c.date < today).limit(app.config['JOB_BATCH_SIZE'])
+            deleted = connection.execute(db.delete(availability).where(availability.c.id.in_(batch))).rowcount
+        if not deleted:
+            break
+        pruned += deleted
+        renew_job_lease()
+    with db.engine.begin() as connection:
+        rules = connection.execute(db.delete(rule).where(rule.c.valid_until < today)).rowcount
+    return f'pruned {pruned} past overrides and {rules} expired weekly rules'
+
+def job_prune_sessions():
+    user_session = UserSession.__table__
+    with db.engine.begin() as connection:
+        pruned = connection.execute(db.delete(user_session).where(or_(
+            user_session.c.expires_at < datetime.utcnow(), user_session.c.revoked_at.is_not(None)
+        ))).rowcount
+        # Any session cached before an older change has expired by now
+        connection.execute(db.delete(CacheVersion.__table__).where(
+            CacheVersion.name >= 'session:', CacheVersion.name < 'session;',
+            CacheVersion.updated_at < datetime.utcnow() - timedelta(hours=app.config['SESSION_LIFETIME_HOURS'])))
+    return f'pruned {pruned} expired or revoked sessions'
+
+def job_prune_events():
+    cutoff = datetime.utcnow() - timedelta(hours=app.config['EVENT_RETENTION_HOURS'])
+    with db.engine.begin() as connection:
+        pruned = connection.execute(db.delete(AppointmentEvent.__table__).where(
+            AppointmentEvent.__table__.c.created_at < cutoff)).rowcount
+    return f'pruned {pruned} appointment events'
+
+def job_archive():
+    cutoff = datetime.now().date() - timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])
+    return f"archived {archive_appointments(cutoff, app.config['JOB_BATCH_SIZE'])} appointments"
+
+JOBS = {
+    # name: (seconds between runs, job)
+    'no-shows': (60 * 60, job_no_shows),
+    'rollups': (60 * 60, job_rollups),
+    'prune-availability': (24 * 60 * 60, job_prune_availability),
+    'prune-sessions': (24 * 60 * 60, job_prune_sessions),
+    'prune-events': (60 * 60, job_prune_events),
+    'archive': (24 * 60 * 60, job_archive),
+}
+
+job_lease = threading.local()  # (name, owner) of the job this thread is running
+
+def acquire_job_lease(name, owner, force=False):
+    job = JobRun.__table__
+    now = datetime.utcnow()
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(db.insert(job).values(name=name))
+    except IntegrityError:
+        pass  # already there
+    due = or_(job.c.last_success_at == None, job.c.last_success_at <= now - timedelta(seconds=JOBS[name][0]))
+    with db.engine.begin() as connection:
+        return connection.execute(
+            db.update(job).where(
+                job.c.name == name,
+                or_(job.c.locked_until == None, job.c.locked_until < now),
+                true() if force else due
+            ).values(
+                locked_by=owner,
+                locked_until=now + timedelta(seconds=app.config['JOB_LEASE_SECONDS']),
+                last_started_at=now
+            )
+        ).rowcount == 1
+
+def renew_job_lease():
+    # Called by jobs after each batch; does nothing outside run_job (archive-appointments)
+    lease = getattr(job_lease, 'current', None)
+    if lease is None:
+        return
+    name, owner = lease
+    job = JobRun.__table__
+    with db.engine.begin() as connection:
+        renewed = connection.execute(db.update(job).where(job.c.name == name, job.c.locked_by == owner).values(
+            locked_until=datetime.utcnow() + timedelta(seconds=app.config['JOB_LEASE_SECONDS'])
+        )).rowcount
+    if not renewed:
+        raise RuntimeError(f'{name} lost its lease, stopping')
+
+def release_job_lease(name, owner, result=None, error=None):
+    job = JobRun.__table__
+    values = {'locked_by': None, 'locked_until': None}
+    if error is None:
+        values.update(last_success_at=datetime.utcnow(), last_result=result)
+    else:
+        values.update(last_failure_at=datetime.utcnow(), last_error=error)
+    with db.engine.begin() as connection:
+        connection.execute(db.update(job).where(job.c.name == name, job.c.locked_by == owner).values(**values))
+
+def job_due(name):
+    interval, _ = JOBS[name]
+    with db.engine.connect() as connection:
+        last_success = connection.execute(
+            db.select(JobRun.__table__.c.last_success_at).where(JobRun.__table__.c.name == name)
+        ).scalar()
+    return last_success is None or last_success + timedelta(seconds=interval) <= datetime.utcnow()
+
+def run_job(name, owner, force=False):
+    if not force and not job_due(name):
+        return 'not due'
+    if not acquire_job_lease(name, owner, force):
+        return 'running elsewhere or just finished'
+    job_lease.current = (name, owner)
+    try:
+        result = JOBS[name][1]()
+    except Exception as e:
+        release_job_lease(name, owner, error=repr(e))
+        raise
+    finally:
+        job_lease.current = None
+    release_job_lease(name, owner, result=result)
+    return result
+
+@app.cli.command('run-jobs')
+@click.argument('names', nargs=-1, type=click.Choice(list(JOBS)))
+@click.option('--force', is_flag=True, help='Run even if the interval has not passed yet.')
+@click.option('--loop', is_flag=True, help='Keep running, checking every JOB_POLL_SECONDS.')
+def run_jobs_command(names, force, loop):
+    try:
+        check_schema()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    owner = f'{socket.gethostname()}:{os.getpid()}'
+    while True:
+        for name in names or JOBS:
+            try:
+                print(f"{datetime.now():%Y-%m-%d %H:%M:%S} {name}: {run_job(name, owner, force)}", flush=True)
+            except Exception as e:
+                if not loop:
+                    raise
+                print(f"{datetime.now():%Y-%m-%d %H:%M:%S} {name} failed: {e!r}", flush=True)
+        if not loop:
+            break
+        clock.sleep(app.config['JOB_POLL_SECONDS'])
+
+@app.cli.command('job-status')
+def job_status_command():
+    runs = {run.name: run for run in JobRun.query.all()}
+    for name in JOBS:
+        run = runs.get(name)
+        if run is None:
+            print(f"{name:20} never run")
+            continue
+        line = f"{name:20} last success {run.last_success_at or 'never'}: {run.last_result or '-'}"
+        if run.locked_until and run.locked_until > datetime.utcnow():
+            line += f" (running on {run.locked_by})"
+        if run.last_failure_at and (run.last_success_at is None or run.last_failure_at > run.last_success_at):
+            line += f" -- failed {run.last_failure_at}: {run.last_error}"
+        print(line)
+
+# ===================== UTILIZATION ANALYTICS =====================
+
+# Reports for /admin/analytics. All counting happens in the database as a few GROUP BY
+# queries over the date range (one row per doctor comes back, not one per appointment).
+# Available hours are worked out arithmetically from the weekly rules plus the date
+# overrides in range, without expanding every day. Results are cached per process by date
+# range for ANALYTICS_CACHE_SECONDS. Archived appointments aren't included, and past
+# availability uses the rules as they are now (the prune job drops old overrides).
+
+def weekday_count(weekday, first, last):
+    if first > last:
+        return 0
+    first = first + timedelta(days=(weekday - first.weekday()) % 7)
+    return (last - first).days // 7 + 1 if first <= last else 0
+
+def window_minutes(start_time, end_time):
+    return bin(window_bits(start_time, end_time)).count('1') * app.config['SLOT_MINUTES']
+
+def rule_applies(rule, day):
+    return (rule.weekday == day.weekday() and (rule.valid_from is None or rule.valid_from <= day)
+            and (rule.valid_until is None or rule.valid_until >= day))
+
+def available_minutes(connection, start, end):
+    rule, availability = AvailabilityRule.__table__, DoctorAvailability.__table__
+    rules = connection.execute(db.select(rule).where(
+        or_(rule.c.valid_from == None, rule.c.valid_from <= end),
+        or_(rule.c.valid_until == None, rule.c.valid_until >= start)
+    )).all()
+    minutes, rules_by_doctor = {}, {}
+    for row in rules:
+        days = weekday_count(row.weekday, max(start, row.valid_from or start), min(end, row.valid_until or end))
+        minutes[row.doctor_id] = minutes.get(row.doctor_id, 0) + days * window_minutes(row.start_time, row.end_time)
+        rules_by_doctor.setdefault(row.doctor_id, []).append(row)
+
+    # A date override replaces that day's rule windows
+    for row in connection.execute(db.select(availability).where(availability.c.date.between(start, end))):
+        change = window_minutes(row.start_time, row.end_time) if row.is_available else 0
+        change -= sum(window_minutes(r.start_time, r.end_time)
+                      for r in rules_by_doctor.get(row.doctor_id, ()) if rule_applies(r, row.date))
+        minutes[row.doctor_id] = minutes.get(row.doctor_id, 0) + change
+    return minutes
+
+def lead_days(connection, appointment):
+    if connection.dialect.name == 'sqlite':
+        return func.julianday(appointment.c.date) - func.julianday(func.date(appointment.c.created_at))
+    return appointment.c.date - func.date(appointment.c.created_at)
+
+def rate(part, whole):
+    return part / whole if whole else None
+
+def utilization_totals(row, available):
+    booked_hours = row['bookings'] * app.config['SLOT_MINUTES'] / 60
+    row.update(
+        available_hours=available / 60,
+        booked_hours=booked_hours,
+        utilization=rate(booked_hours, available / 60),
+        cancellation_rate=rate(row['cancelled'], row['total']),
+        no_show_rate=rate(row['no_show'], row['bookings']),
+        lead_days=rate(row.pop('lead_days_sum'), row['total']),
+    )
+    return row
+
+def compute_utilization(start, end):
+    appointment, treatment, doctor = Appointment.__table__, Treatment.__table__, Doctor.__table__
+
+    def status_count(*statuses):
+        return func.sum(db.case((appointment.c.status.in_(statuses), 1), else_=0))
+
+    with db.engine.connect() as connection:
+        counts = {row.doctor_id: row for row in connection.execute(
+            db.select(
+                appointment.c.doctor_id,
+                func.count().label('total'),
+                status_count('Booked', 'Completed', 'NoShow').label('bookings'),
+                status_count('Completed').label('completed'),
+                status_count('Cancelled').label('cancelled'),
+                status_count('NoShow').label('no_show'),
+                func.coalesce(func.sum(lead_days(connection, appointment)), 0).label('lead_days_sum'),
+            ).where(appointment.c.date.between(start, end)).group_by(appointment.c.doctor_id)
+        )}
+        minutes = available_minutes(connection, start, end)
+        diagnosis = func.lower(func.trim(treatment.c.diagnosis))
+        diagnoses = connection.execute(
+            db.select(diagnosis.label('diagnosis'), func.count().label('count')).select_from(
+                treatment.join(appointment, appointment.c.id == treatment.c.appointment_id)
+            ).where(appointment.c.date.between(start, end)).group_by(diagnosis).order_by(
+                func.count().desc()).limit(app.config['ANALYTICS_TOP_DIAGNOSES'])
+        ).all()
+        doctors = connection.execute(db.select(doctor.c.id, doctor.c.name, doctor.c.department_id).where(
+            or_(doctor.c.is_active == True, doctor.c.id.in_(list(counts)))
+        )).all()
+        departments = dict(connection.execute(db.select(Department.__table__.c.id, Department.__table__.c.name)).all())
+
+    fields = ('total', 'bookings', 'completed', 'cancelled', 'no_show', 'lead_days_sum')
+    doctor_rows, department_rows = [], {}
+    for doctor_id, name, department_id in doctors:
+        row = counts.get(doctor_id)
+        values = {field: (getattr(row, field) or 0) if row else 0 for field in fields}
+        available = minutes.get(doctor_id, 0)
+        department = department_rows.setdefault(department_id, dict(
+            {field: 0 for field in fields}, id=department_id, name=departments.get(department_id), doctors=0, minutes=0))
+        department['doctors'] += 1
+        department['minutes'] += available
+        for field in fields:
+            department[field] += values[field]
+        doctor_rows.append(utilization_totals(dict(values, id=doctor_id, name=name, department_id=department_id,
+                                                   department=departments.get(department_id)), available))
+
+    return {
+        'start': start,
+        'end': end,
+        'departments': sorted((utilization_totals(row, row.pop('minutes')) for row in department_rows.values()),
+                              key=lambda row: row['name'] or ''),
+        'doctors': sorted(doctor_rows, key=lambda row: row['bookings'], reverse=True),
+        'diagnoses': [(row.diagnosis, row.count) for row in diagnoses],
+        'generated_at': datetime.now(),
+    }
+
+analytics_cache = ReferenceCache(app.config['ANALYTICS_CACHE_SIZE'])
+
+def cached_utilization(start, end):
+    # The version is the current time bucket, so entries go stale after ANALYTICS_CACHE_SECONDS
+    bucket = int(clock.time() // app.config['ANALYTICS_CACHE_SECONDS'])
+    return analytics_cache.get(('utilization', start, end), bucket, lambda: compute_utilization(start, end))
+
+@app.cli.command('analytics-report')
+@click.option('--start', help='First day (YYYY-MM-DD), 30 days ago by default.')
+@click.option('--end', help='Last day (YYYY-MM-DD), today by default.')
+def analytics_report_command(start, end):
+    today = datetime.now().date()
+    try:
+        start = datetime.strptime(start, '%Y-%m-%d').date() if start else today - timedelta(days=30)
+        end = datetime.strptime(end, '%Y-%m-%d').date() if end else today
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    started = clock.monotonic()
+    report = compute_utilization(start, end)
+    print(f"{'department':20} {'doctors':>8} {'bookings':>9} {'avail h':>9} {'util':>6} {'cancel':>7} {'lead d':>7}")
+    for row in report['departments']:
+        print(f"{row['name'] or '-':20} {row['doctors']:8d} {row['bookings']:9d} {row['available_hours']:9.0f} "
+              f"{row['utilization'] or 0:6.0%} {row['cancellation_rate'] or 0:7.1%} {row['lead_days'] or 0:7.1f}")
+    print(f"Computed {start} to {end} in {clock.monotonic() - started:.2f}s")
+
+# ===================== SQLITE CONCURRENCY BENCHMARK =====================
+
+# flask bench-sqlite runs the same mixed read/write load from several processes against a
+# scratch database, once with SQLite's defaults and once with SQLITE_PRAGMAS, and reports
+# operations per second and "database is locked" failures for each.
+
+def bench_worker(path, pragmas, seconds, write_ratio, seed):
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    apply_sqlite_pragmas(connection, pragmas)
+    reads = writes = errors = 0
+    deadline = clock.monotonic() + seconds
+    while clock.monotonic() < deadline:
+        try:
+            if rng.random() < write_ratio:
+                connection.execute(
+                    'INSERT INTO booking (doctor_id, day, slot) VALUES (?, ?, ?)',
+                    (rng.randrange(100), rng.randrange(30), rng.randrange(16))
+                )
+                connection.commit()
+                writes += 1
+            else:
+                connection.execute(
+                    'SELECT count(*) FROM booking WHERE doctor_id = ? AND day BETWEEN ? AND ?',
+                    (rng.randrange(100), 0, 7)
+                ).fetchone()
+                reads += 1
+        except sqlite3.OperationalError:
+            connection.rollback()
+            errors += 1
+    connection.close()
+    return reads, writes, errors
+
+def run_sqlite_bench(pragmas, workers, seconds, write_ratio):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        setup = sqlite3.connect(path)
+        apply_sqlite_pragmas(setup, pragmas)
+        setup.execute('CREATE TABLE booking (id INTEGER PRIMARY KEY, doctor_id INTEGER, day INTEGER, slot INTEGER)')
+        setup.execute('CREATE INDEX ix_booking_doctor_day ON booking (doctor_id, day)')
+        setup.executemany('INSERT INTO booking (doctor_id, day, slot) VALUES (?, ?, ?)',
+                          [(i % 100, i % 30, i % 16) for i in range(50000)])
+        setup.commit()
+        setup.close()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(bench_worker, [path] * workers, [pragmas] * workers,
+                                    [seconds] * workers, [write_ratio] * workers, range(workers)))
+    reads, writes, errors = (sum(column) for column in zip(*results))
+    return reads / seconds, writes / seconds, errors
+
+@app.cli.command('bench-sqlite')
+@click.option('--workers', default=4, show_default=True)
+@click.option('--seconds', default=5.0, show_default=True)
+@click.option('--write-ratio', default=0.2, show_default=True)
+def bench_sqlite_command(workers, seconds, write_ratio):
+    for label, pragmas in (('defaults', {}), ('tuned', app.config['SQLITE_PRAGMAS'])):
+        reads, writes, errors = run_sqlite_bench(pragmas, workers, seconds, write_ratio)
+        print(f"{label:9} reads/s {reads:10.0f}  writes/s {writes:8.0f}  locked errors {errors}")
+
+# ===================== BOOKING STRESS TEST =====================
+
+# flask stress-booking fires concurrent bookings from many threads at a small set of slots,
+# then checks that no slot ended up with two booked appointments. It creates its own doctor
+# and patients, so point DATABASE_URL at a scratch database when running it.
+
+def stress_worker(doctor_id, patient_id, slots, attempts, seed, results):
+    rng = random.Random(seed)
+    booked = conflicts = errors = 0
+    with app.app_context():
+        for _ in range(attempts):
+            date, time = rng.choice(slots)
+            try:
+                if book_slot(patient_id, doctor_id, date, time, 'stress test'):
+                    booked += 1
+                else:
+                    conflicts += 1
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+        db.session.remove()
+    results.append((booked, conflicts, errors))
+
+@app.cli.command('stress-booking')
+@click.option('--threads', default=16, show_default=True)
+@click.option('--attempts', default=100, show_default=True, help='Booking attempts per thread.')
+@click.option('--days', default=30, show_default=True)
+@click.option('--slots-per-day', default=16, show_default=True)
+@click.option('--force', is_flag=True, help='Run even if the database already has doctors.')
+def stress_booking_command(threads, attempts, days, slots_per_day, force):
+    init_db()
+    if Doctor.query.first() and not force:
+        raise click.ClickException('The database already has data; use a scratch DATABASE_URL or --force.')
+
+    password = hash_password('stress')
+    doctor = Doctor(name='Stress Doctor', email=f'stress-{clock.time()}@doctor.test', password=password,
+                    department_id=Department.query.first().id)
+    patients = [Patient(name=f'Stress Patient {i}', email=f'stress-{clock.time()}-{i}@patient.test', password=password)
+                for i in range(threads)]
+    db.session.add(doctor)
+    db.session.add_all(patients)
+    bump_stat('active_doctors')
+    bump_stat('active_patients', len(patients))
+    db.session.commit()
 
-db = SQLAlchemy(app)
+    first_day = datetime.now().date() + timedelta(days=365)
+    slots = [(first_day + timedelta(days=d), slot_start(slot_index(datetime.min.time().replace(hour=9)) + s))
+             for d in range(days) for s in range(slots_per_day)]
+    results = []
+    workers = [threading.Thread(target=stress_worker, args=(doctor.id, patient.id, slots, attempts, i, results))
+               for i, patient in enumerate(patients)]
+    started = clock.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = clock.monotonic() - started
 
-# ===================== DATABASE MODELS =====================
+    booked, conflicts, errors = (sum(column) for column in zip(*results))
+    double_booked = db.session.query(Appointment.date, Appointment.time).filter_by(
+        doctor_id=doctor.id, status='Booked'
+    ).group_by(Appointment.date, Appointment.time).having(func.count() > 1).count()
+    stored = Appointment.query.filter_by(doctor_id=doctor.id, status='Booked').count()
 
-class Admin(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
-    password = db.Column(db.String(200), nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
+    print(f"{threads} threads x {attempts} attempts on {len(slots)} slots in {elapsed:.2f}s")
+    print(f"booked {booked}, rejected as taken {conflicts}, lock errors {errors}")
+    print(f"{(booked + conflicts) / elapsed:.0f} booking attempts/s, {booked / elapsed:.0f} bookings/s")
+    print(f"double booked slots: {double_booked}, booked rows stored: {stored}")
+    if double_booked or stored != booked:
+        raise SystemExit(1)
 
-class Department(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), unique=True, nullable=False)
-    description = db.Column(db.Text)
-    doctors = db.relationship('Doctor', backref='department', lazy=True)
+# ===================== SYNTHETIC DATA GENERATOR =====================
 
-class Doctor(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
-    password = db.Column(db.String(200), nullable=False)
-    phone = db.Column(db.String(20))
-    department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False)
-    experience = db.Column(db.Integer)
-    is_active = db.Column(db.Boolean, default=True)
-    appointments = db.relationship('Appointment', backref='doctor', lazy=True)
-    availability = db.relationship('DoctorAvailability', backref='doctor', lazy=True)
+# flask generate-data fills the database with a reproducible hospital: the same --seed always
+# gives the same rows. Rows are written with executemany in --batch-size chunks, ids are
+# assigned up front so appointments and treatments can refer to them without reading back,
+# and the dashboard statistics are rebuilt once at the end. Every generated doctor and
+# patient has the password given by --password.
+#
+# Each doctor works Monday to Friday 09:00-17:00 (weekly availability rules). Their
+# appointments fill consecutive 30 minute slots, ending two weeks from today: past ones are
+# mostly Completed (with a treatment), future ones mostly Booked, so no slot is booked twice.
 
-class Patient(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
-    password = db.Column(db.String(200), nullable=False)
-    phone = db.Column(db.String(20))
-    age = db.Column(db.Integer)
-    gender = db.Column(db.String(10))
-    address = db.Column(db.Text)
-    is_active = db.Column(db.Boolean, default=True)
-    appointments = db.relationship('Appointment', backref='patient', lazy=True)
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+               'Aarav', 'Priya', 'Wei', 'Mei', 'Omar', 'Fatima', 'Carlos', 'Sofia', 'Kenji', 'Yuki']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Sharma', 'Patel',
+              'Chen', 'Wang', 'Khan', 'Ali', 'Lopez', 'Gonzalez', 'Tanaka', 'Sato', 'Murphy', 'Kelly']
+REASONS = ['Routine checkup', 'Follow-up visit', 'Chest pain', 'Headache', 'Back pain', 'Skin rash',
+           'Fever', 'Vaccination', 'Joint pain', 'Blood test results']
+DIAGNOSES = ['Hypertension', 'Migraine', 'Common cold', 'Eczema', 'Sprain', 'Influenza', 'Healthy']
+GENERATED_DAYS_AHEAD = 14
+GENERATED_SLOTS_PER_DAY = 16
 
-class DoctorAvailability(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
-    date = db.Column(db.Date, nullable=False)
-    start_time = db.Column(db.Time, nullable=False)
-    end_time = db.Column(db.Time, nullable=False)
-    is_available = db.Column(db.Boolean, default=True)
+def next_id(connection, model):
+    return (connection.execute(db.select(func.max(model.__table__.c.id))).scalar() or 0) + 1
 
-class Appointment(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
-    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
-    date = db.Column(db.Date, nullable=False)
-    time = db.Column(db.Time, nullable=False)
-    reason = db.Column(db.Text)
-    status = db.Column(db.String(20), default='Booked')  # Booked, Completed, Cancelled
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    treatment = db.relationship('Treatment', backref='appointment', uselist=False, lazy=True)
+def person_name(rng):
+    return f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
 
-class Treatment(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=False)
-    diagnosis = db.Column(db.Text)
-    prescription = db.Column(db.Text)
-    notes = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+def generated_doctors(rng, first_id, count, department_ids, password):
+    for doctor_id in range(first_id, first_id + count):
+        yield {'id': doctor_id, 'name': f'Dr. {person_name(rng)}', 'email': f'doctor{doctor_id}@generated.test',
+               'password': password, 'phone': f'555{doctor_id:07d}', 'department_id': rng.choice(department_ids),
+               'experience': rng.randint(1, 40), 'is_active': True}
 
-# ===================== DECORATORS FOR LOGIN REQUIRED =====================
+def generated_patients(rng, first_id, count, password):
+    for patient_id in range(first_id, first_id + count):
+        yield {'id': patient_id, 'name': person_name(rng), 'email': f'patient{patient_id}@generated.test',
+               'password': password, 'phone': f'777{patient_id:07d}', 'age': rng.randint(1, 95),
+               'gender': rng.choice(['Male', 'Female', 'Other']), 'address': f'{rng.randint(1, 999)} Main Street',
+               'is_active': True}
 
-def login_required(role):
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            if 'user_id' not in session or session.get('role') != role:
-                flash('Please login first', 'danger')
-                return redirect(url_for('login'))
-            return f(*args, **kwargs)
-        return decorated_function
-    return decorator
+def generated_rules(doctor_ids):
+    for doctor_id in doctor_ids:
+        for weekday in range(5):
+            yield {'doctor_id': doctor_id, 'weekday': weekday, 'start_time': slot_start(slot_index(datetime.min.time().replace(hour=9))),
+                   'end_time': datetime.min.time().replace(hour=17), 'valid_from': None, 'valid_until': None}
 
-# ===================== INITIALIZE DATABASE & ADMIN =====================
+def generated_visits(rng, first_id, count, doctor_ids, patient_ids, today):
+    # -> (appointment row, treatment row or None)
+    per_doctor = -(-count // len(doctor_ids))
+    first_day = today - timedelta(days=-(-per_doctor // GENERATED_SLOTS_PER_DAY) - GENERATED_DAYS_AHEAD)
+    first_slot = slot_index(datetime.min.time().replace(hour=9))
+    created = datetime.combine(first_day, datetime.min.time())
+    for n in range(count):
+        doctor_id = doctor_ids[n % len(doctor_ids)]
+        day_number, slot = divmod(n // len(doctor_ids), GENERATED_SLOTS_PER_DAY)
+        day = first_day + timedelta(days=day_number)
+        if day >= today:
+            status = 'Booked' if rng.random() < 0.9 else 'Cancelled'
+        else:
+            status = 'Completed' if rng.random() < 0.8 else 'Cancelled'
+        appointment_id = first_id + n
+        appointment = {'id': appointment_id, 'patient_id': rng.choice(patient_ids), 'doctor_id': doctor_id,
+                       'date': day, 'time': slot_start(first_slot + slot), 'reason': rng.choice(REASONS),
+                       'status': status, 'created_at': created}
+        treatment = None
+        if status == 'Completed':
+            treatment = {'appointment_id': appointment_id, 'diagnosis': rng.choice(DIAGNOSES),
+                         'prescription': 'Rest and fluids', 'notes': None, 'created_at': created}
+        yield appointment, treatment
 
-def init_db():
-    with app.app_context():
-        db.create_all()
-        
-        # Create admin if doesn't exist
-        if not Admin.query.first():
-            admin = Admin(
-                username='admin',
-                email='admin@hospital.com',
-                password=generate_password_hash('admin123')
-            )
-            db.session.add(admin)
-            db.session.commit()
-            print("Admin created - Username: admin, Password: admin123")
-        
-        # Create sample departments if none exist
-        if not Department.query.first():
-            departments = [
-                Department(name='Cardiology', description='Heart and cardiovascular system'),
-                Department(name='Neurology', description='Brain and nervous system'),
-                Department(name='Orthopedics', description='Bones and joints'),
-                Department(name='Pediatrics', description='Children health'),
-                Department(name='Dermatology', description='Skin conditions')
-            ]
-            db.session.add_all(departments)
-            db.session.commit()
-            print("Sample departments created")
+def insert_batches(model, rows, batch_size):
+    inserted = 0
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_size)):
+        with db.engine.begin() as connection:
+            connection.execute(db.insert(model.__table__), batch)
+        inserted += len(batch)
+    return inserted
+
+def insert_visits(visits, batch_size):
+    appointments = treatments = 0
+    while batch := list(islice(visits, batch_size)):
+        with db.engine.begin() as connection:
+            connection.execute(db.insert(Appointment.__table__), [appointment for appointment, _ in batch])
+            rows = [treatment for _, treatment in batch if treatment]
+            if rows:
+                connection.execute(db.insert(Treatment.__table__), rows)
+        appointments += len(batch)
+        treatments += len(rows)
+        print(f"  {appointments} appointments", end='\r', flush=True)
+    print()
+    return appointments, treatments
+
+@app.cli.command('generate-data')
+@click.option('--departments', default=5, show_default=True, help='Make sure at least this many departments exist.')
+@click.option('--doctors', default=100, show_default=True)
+@click.option('--patients', default=1000, show_default=True)
+@click.option('--appointments', default=10000, show_default=True)
+@click.option('--seed', default=42, show_default=True)
+@click.option('--batch-size', default=10000, show_default=True, help='Rows per transaction.')
+@click.option('--password', default='password', show_default=True, help='Password of every generated user.')
+@click.option('--force', is_flag=True, help='Add to a database that already has doctors or patients.')
+def generate_data_command(departments, doctors, patients, appointments, seed, batch_size, password, force):
+    init_db()
+    if (Doctor.query.first() or Patient.query.first()) and not force:
+        raise click.ClickException('The database already has data; use a scratch DATABASE_URL or --force.')
+    if appointments and not (doctors and patients):
+        raise click.BadParameter('appointments need at least one doctor and one patient')
+
+    rng = random.Random(seed)
+    started = clock.monotonic()
+    # Hashing is deliberately slow, so everyone shares one hash
+    password = hash_password(password)
+
+    existing = Department.query.count()
+    db.session.add_all(Department(name=f'Department {n}', description='Generated department')
+                       for n in range(existing + 1, departments + 1))
+    db.session.commit()
+    department_ids = [id for id, in db.session.query(Department.id).order_by(Department.id)]
+
+    with db.engine.connect() as connection:
+        first_doctor, first_patient, first_appointment = (
+            next_id(connection, model) for model in (Doctor, Patient, Appointment))
+    doctor_ids = list(range(first_doctor, first_doctor + doctors))
+    patient_ids = range(first_patient, first_patient + patients)
+
+    print(f"doctors: {insert_batches(Doctor, generated_doctors(rng, first_doctor, doctors, department_ids, password), batch_size)}")
+    print(f"availability rules: {insert_batches(AvailabilityRule, generated_rules(doctor_ids), batch_size)}")
+    print(f"patients: {insert_batches(Patient, generated_patients(rng, first_patient, patients, password), batch_size)}")
+    if appointments:
+        visits = generated_visits(rng, first_appointment, appointments, doctor_ids, patient_ids, datetime.now().date())
+        print("appointments: %d, treatments: %d" % insert_visits(visits, batch_size))
+
+    with db.engine.begin() as connection:
+        write_stats(connection, compute_stats(connection))
+        rebuild_roster(connection)
+        bump_directory_version(connection)
+    print(f"Generated in {clock.monotonic() - started:.1f}s")
+
+# ===================== ROUTE BENCHMARK =====================
+
+# flask bench-routes logs in as each role with the test client, requests every main page
+# --requests times and reports p50/p95 latency, SQL statements per request and the peak
+# Python memory allocated while serving one request. Run it against data made by
+# generate-data. --save writes the results as the baseline, later runs compare against it
+# and exit with status 1 when a page's median got slower than --tolerance allows (and by more
+# than --min-ms, so sub-millisecond jitter doesn't count) or it runs more queries.
+# While it runs MAX_QUERIES_PER_REQUEST is set to --max-queries, and every page is also
+# fetched with per_page=1 and per_page=MAX_PAGE_SIZE: a list page whose query count differs
+# between the two is lazy loading per row, and fails the run as well.
+# Booking requests really book slots, so use a scratch database.
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def bench_plan(doctor_id, patient_id, appointment_id, booking_slots):
+    department_id = db.session.get(Doctor, doctor_id).department_id
+    patient_name = db.session.get(Patient, patient_id).name.split()[0]
+
+    def next_booking():
+        day, time = next(booking_slots, (datetime.now().date(), datetime.min.time()))
+        return {'slot': f"{day.isoformat()}T{time.strftime('%H:%M')}", 'reason': 'benchmark'}
+
+    return [
+        ('admin', 'admin_dashboard', 'GET', '/admin/dashboard', None),
+        ('admin', 'admin_doctors', 'GET', '/admin/doctors', None),
+        ('admin', 'admin_doctors?search=', 'GET', '/admin/doctors?search=Smith', None),
+        ('admin', 'admin_patients', 'GET', '/admin/patients', None),
+        ('admin', 'admin_patients?search=', 'GET', f'/admin/patients?search={patient_name}', None),
+        ('admin', 'admin_appointments', 'GET', '/admin/appointments', None),
+        ('admin', 'admin_upcoming_appointments', 'GET', '/admin/upcoming_appointments', None),
+        ('doctor', 'doctor_dashboard', 'GET', '/doctor/dashboard', None),
+        ('doctor', 'doctor_appointments', 'GET', '/doctor/appointments', None),
+        ('doctor', 'doctor_availability', 'GET', '/doctor/availability', None),
+        ('doctor', 'patient_history', 'GET', f'/doctor/patient_history/{patient_id}', None),
+        ('doctor', 'complete_appointment', 'GET', f'/doctor/complete_appointment/{appointment_id}', None),
+        ('patient', 'patient_dashboard', 'GET', '/patient/dashboard', None),
+        ('patient', 'patient_doctors', 'GET', '/patient/doctors', None),
+        ('patient', 'patient_doctors?department_id=', 'GET', f'/patient/doctors?department_id={department_id}', None),
+        ('patient', 'patient_doctors?search=', 'GET', '/patient/doctors?search=Smith', None),
+        ('patient', 'book_appointment', 'GET', f'/patient/book_appointment/{doctor_id}', None),
+        ('patient', 'book_appointment POST', 'POST', f'/patient/book_appointment/{doctor_id}', next_booking),
+        ('patient', 'patient_appointments', 'GET', '/patient/appointments', None),
+        ('patient', 'treatment_history', 'GET', '/patient/treatment_history', None),
+        ('patient', 'patient_profile', 'GET', '/patient/profile', None),
+    ]
+
+def bench_route(client, method, url, data, requests, queries):
+    timings, counts = [], []
+    for _ in range(requests):
+        body = data() if data else None
+        queries[0] = 0
+        started = clock.perf_counter()
+        response = client.open(url, method=method, data=body)
+        timings.append(clock.perf_counter() - started)
+        counts.append(queries[0])
+        if response.status_code >= 400:
+            raise click.ClickException(f'{method} {url} returned {response.status_code}')
+
+    # One more request with tracemalloc on, which would skew the timings above
+    tracemalloc.start()
+    client.open(url, method=method, data=data() if data else None)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'p50_ms': percentile(timings, 0.5) * 1000, 'p95_ms': percentile(timings, 0.95) * 1000,
+            'queries': max(counts), 'peak_kb': peak / 1024}
+
+def page_query_counts(client, url, queries):
+    counts = []
+    for per_page in (1, app.config['MAX_PAGE_SIZE']):
+        # The first request fills the per-process caches, count the second one
+        for _ in range(2):
+            queries[0] = 0
+            response = client.get(f"{url}{'&' if '?' in url else '?'}per_page={per_page}")
+            if response.status_code >= 400:
+                raise click.ClickException(f'GET {url} returned {response.status_code}')
+        counts.append(queries[0])
+    return counts
+
+@app.cli.command('bench-routes')
+@click.option('--requests', default=20, show_default=True, help='Timed requests per page.')
+@click.option('--admin-email', default='admin@hospital.com', show_default=True)
+@click.option('--admin-password', default='admin123', show_default=True)
+@click.option('--password', default='password', show_default=True, help='Password of the doctor and patient.')
+@click.option('--baseline', default='bench-baseline.json', show_default=True, type=click.Path(dir_okay=False))
+@click.option('--save', is_flag=True, help='Store this run as the new baseline.')
+@click.option('--tolerance', default=0.25, show_default=True, help='Allowed p50 slowdown against the baseline.')
+@click.option('--min-ms', default=2.0, show_default=True, help='Ignore p50 slowdowns smaller than this.')
+@click.option('--max-queries', default=20, show_default=True, help='Fail any request running more SQL statements.')
+def bench_routes_command(requests, admin_email, admin_password, password, baseline, save, tolerance, min_ms,
+                         max_queries):
+    # The busiest doctor at the end of the generated range has both past and upcoming visits
+    appointment = Appointment.query.filter_by(status='Booked').order_by(Appointment.id.desc()).first()
+    if appointment is None:
+        raise click.ClickException('No booked appointments; run flask generate-data first.')
+    doctor = db.session.get(Doctor, appointment.doctor_id)
+    patient = db.session.get(Patient, appointment.patient_id)
+    # Each booking POST takes a different free slot inside the booking window
+    booking_slots = iter([(day, time) for day, times in sorted(free_slots([doctor.id]).get(doctor.id, {}).items())
+                          for time in times])
+    plan = bench_plan(doctor.id, patient.id, appointment.id, booking_slots)
+    db.session.remove()
+
+    clients = {}
+    for role, email, secret in (('admin', admin_email, admin_password), ('doctor', doctor.email, password),
+                                ('patient', patient.email, password)):
+        clients[role] = app.test_client()
+        response = clients[role].post('/login', data={'email': email, 'password': secret, 'role': role})
+        if 'dashboard' not in response.location:
+            raise click.ClickException(f'Could not log in as {role} {email}')
+
+    queries = [0]
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        queries[0] += 1
+    event.listen(db.engine, 'before_cursor_execute', count_query)
+    app.config['MAX_QUERIES_PER_REQUEST'] = max_queries
+    try:
+        scaling = {name: page_query_counts(clients[role], url, queries)
+                   for role, name, method, url, data in plan if method == 'GET'}
+        results = {name: bench_route(clients[role], method, url, data, requests, queries)
+                   for role, name, method, url, data in plan}
+    finally:
+        app.config['MAX_QUERIES_PER_REQUEST'] = None
+        event.remove(db.engine, 'before_cursor_execute', count_query)
+
+    previous = {}
+    if os.path.exists(baseline) and not save:
+        with open(baseline) as f:
+            previous = json.load(f)
+
+    regressions = []
+    print(f"{'page':34} {'p50 ms':>8} {'p95 ms':>8} {'queries':>8} {'peak KB':>9}  vs baseline")
+    for name, result in results.items():
+        line = f"{name:34} {result['p50_ms']:8.1f} {result['p95_ms']:8.1f} {result['queries']:8d} {result['peak_kb']:9.0f}"
+        old = previous.get(name)
+        if old:
+            change = result['p50_ms'] / old['p50_ms'] - 1 if old['p50_ms'] else 0
+            line += f"  p50 {change:+.0%}, queries {result['queries'] - old['queries']:+d}"
+            slower = change > tolerance and result['p50_ms'] - old['p50_ms'] > min_ms
+            if slower or result['queries'] > old['queries']:
+                regressions.append(name)
+                line += '  REGRESSION'
+        print(line)
+
+    if save:
+        with open(baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {baseline}")
+    growing = [name for name, (small, full) in scaling.items() if small != full]
+    for name in growing:
+        small, full = scaling[name]
+        print(f"{name}: {small} queries with per_page=1, {full} with per_page={app.config['MAX_PAGE_SIZE']}")
+    if regressions:
+        raise click.ClickException(f"Slower than baseline: {', '.join(regressions)}")
+    if growing:
+        raise click.ClickException(f"Query count grows with the page size: {', '.join(growing)}")
+
+# ===================== HTTP LOAD TEST =====================
+
+# flask bench-http --url http://127.0.0.1:8000 drives an already running server (gunicorn or
+# python app.py) from --concurrency threads for --seconds. Each thread logs in once and keeps
+# its own connection, then requests the --path pages in turn. Prints requests per second and
+# p50/p95 latency, to compare the production setup against the development server.
+
+def http_login(url, email, password, role):
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+    body = urlencode({'email': email, 'password': password, 'role': role})
+    connection.request('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = connection.getresponse()
+    response.read()
+    if response.status != 302 or 'dashboard' not in (response.getheader('Location') or ''):
+        raise click.ClickException(f'Could not log in as {role} {email}')
+    return connection, {'Cookie': response.getheader('Set-Cookie').split(';')[0]}
+
+def http_worker(connection, headers, paths, deadline, timings, errors):
+    for path in cycle(paths):
+        if clock.perf_counter() >= deadline:
+            break
+        started = clock.perf_counter()
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            ok = False
+        (timings if ok else errors).append(clock.perf_counter() - started)
+    connection.close()
+
+@app.cli.command('bench-http')
+@click.option('--url', default='http://127.0.0.1:8000', show_default=True)
+@click.option('--concurrency', default=8, show_default=True, help='Client threads.')
+@click.option('--seconds', default=10.0, show_default=True)
+@click.option('--path', 'paths', multiple=True, help='Page to request; repeat for several.')
+@click.option('--email', default='admin@hospital.com', show_default=True)
+@click.option('--password', default='admin123', show_default=True)
+@click.option('--role', default='admin', show_default=True, type=click.Choice(['admin', 'doctor', 'patient']))
+def bench_http_command(url, concurrency, seconds, paths, email, password, role):
+    paths = paths or [f'/{role}/dashboard']
+    # Log everyone in first so password hashing isn't part of the measurement
+    logins = [http_login(url, email, password, role) for _ in range(concurrency)]
+    timings, errors = [], []
+    deadline = clock.perf_counter() + seconds
+    threads = [threading.Thread(target=http_worker, args=(connection, headers, paths, deadline, timings, errors))
+               for connection, headers in logins]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if not timings:
+        raise click.ClickException(f'No successful requests ({len(errors)} errors)')
+    print(f"{len(timings)} requests in {seconds:.0f}s from {concurrency} threads: "
+          f"{len(timings) / seconds:.1f} req/s, p50 {percentile(timings, 0.5) * 1000:.1f} ms, "
+          f"p95 {percentile(timings, 0.95) * 1000:.1f} ms, {len(errors)} errors")
 
 # ===================== HOME & AUTH ROUTES =====================
 
@@ -133,38 +3032,35 @@ def login(role_type=None):
         password = request.form.get('password')
         role = request.form.get('role') or role_type
         
-        if role == 'admin':
-            user = Admin.query.filter_by(email=email).first()
-            if user and check_password_hash(user.password, password):
-                session['user_id'] = user.id
-                session['role'] = 'admin'
-                session['name'] = user.username
+        address = request.remote_addr
+        account_key = ((email or '').strip().lower(), address)
+        if account_failures.blocked(account_key) or address_failures.blocked(address):
+            flash('Too many failed logins, please try again later', 'danger')
+            return render_template('login.html', role_type=role_type), 429, \
+                {'Retry-After': str(app.config['LOGIN_WINDOW_SECONDS'])}
+
+        account = find_account(email, role)
+        try:
+            valid = account is not None and check_login(account, password)
+        except LoginBusy:
+            flash('Many people are logging in right now, please try again in a few seconds', 'warning')
+            return render_template('login.html', role_type=role_type), 503, {'Retry-After': '5'}
+
+        if valid:
+            account_failures.clear(account_key)
+            if account.is_active:
+                session.clear()
+                session['sid'] = start_session(account.role, account.id)
+                session['user_id'] = account.id
+                session['role'] = account.role
+                session['name'] = account.name
                 flash('Login successful!', 'success')
-                return redirect(url_for('admin_dashboard'))
-        
-        elif role == 'doctor':
-            user = Doctor.query.filter_by(email=email).first()
-            if user and check_password_hash(user.password, password):
-                if user.is_active:
-                    session['user_id'] = user.id
-                    session['role'] = 'doctor'
-                    session['name'] = user.name
-                    flash('Login successful!', 'success')
-                    return redirect(url_for('doctor_dashboard'))
-                else:
-                    flash('Your account has been deactivated', 'danger')
-        
-        elif role == 'patient':
-            user = Patient.query.filter_by(email=email).first()
-            if user and check_password_hash(user.password, password):
-                if user.is_active:
-                    session['user_id'] = user.id
-                    session['role'] = 'patient'
-                    session['name'] = user.name
-                    flash('Login successful!', 'success')
-                    return redirect(url_for('patient_dashboard'))
-                else:
-                    flash('Your account has been deactivated', 'danger')
+                return redirect(url_for(f'{account.role}_dashboard'))
+            else:
+                flash('Your account has been deactivated', 'danger')
+        else:
+            account_failures.record(account_key)
+            address_failures.record(address)
         
         flash('Invalid credentials', 'danger')
     
@@ -188,13 +3084,14 @@ def register():
         patient = Patient(
             name=name,
             email=email,
-            password=generate_password_hash(password),
+            password=hash_password(password),
             phone=phone,
             age=age,
             gender=gender,
             address=address
         )
         db.session.add(patient)
+        bump_stat('active_patients')
         db.session.commit()
         
         flash('Registration successful! Please login', 'success')
@@ -204,6 +3101,8 @@ def register():
 
 @app.route('/logout')
 def logout():
+    if 'sid' in session:
+        end_session(session['sid'])
     session.clear()
     flash('Logged out successfully', 'success')
     return redirect(url_for('index'))
@@ -213,13 +3112,10 @@ def logout():
 @app.route('/admin/dashboard')
 @login_required('admin')
 def admin_dashboard():
-    total_doctors = Doctor.query.filter_by(is_active=True).count()
-    total_patients = Patient.query.filter_by(is_active=True).count()
-    total_appointments = Appointment.query.count()
-    upcoming_appointments = Appointment.query.filter(
-        Appointment.date >= datetime.now().date(),
-        Appointment.status == 'Booked'
-    ).count()
+    total_doctors, total_patients, total_appointments = get_stats(
+        'active_doctors', 'active_patients', 'total_appointments'
+    )
+    upcoming_appointments = upcoming_booked_count(datetime.now().date())
     
     return render_template('admin_dashboard.html',
                          total_doctors=total_doctors,
@@ -231,16 +3127,13 @@ def admin_dashboard():
 @login_required('admin')
 def admin_doctors():
     search = request.args.get('search', '')
+    query = Doctor.query.options(joinedload(Doctor.department))
     if search:
-        doctors = Doctor.query.filter(
-            (Doctor.name.contains(search)) | 
-            (Doctor.email.contains(search))
-        ).all()
+        page = KeysetPage(text_search(query, Doctor, search, ['name', 'email']).all())
     else:
-        doctors = Doctor.query.all()
-    
-    departments = Department.query.all()
-    return render_template('admin_doctors.html', doctors=doctors, departments=departments)
+        page = paginate_keyset(query, (Doctor.id,))
+    departments = cached_departments()
+    return render_template('admin_doctors.html', doctors=page.items, page=page, departments=departments)
 
 @app.route('/admin/add_doctor', methods=['POST'])
 @login_required('admin')
@@ -259,12 +3152,14 @@ def add_doctor():
     doctor = Doctor(
         name=name,
         email=email,
-        password=generate_password_hash(password),
+        password=hash_password(password),
         phone=phone,
         department_id=department_id,
         experience=experience
     )
     db.session.add(doctor)
+    bump_stat('active_doctors')
+    bump_directory_version()
     db.session.commit()
     
     flash('Doctor added successfully', 'success')
@@ -278,6 +3173,8 @@ def edit_doctor(id):
     doctor.phone = request.form.get('phone')
     doctor.department_id = request.form.get('department_id')
     doctor.experience = request.form.get('experience')
+    bump_directory_version()
+    sessions_changed('doctor', doctor.id)
     
     db.session.commit()
     flash('Doctor updated successfully', 'success')
@@ -287,7 +3184,12 @@ def edit_doctor(id):
 @login_required('admin')
 def delete_doctor(id):
     doctor = Doctor.query.get_or_404(id)
-    doctor.is_active = False
+    if doctor.is_active:
+        doctor.is_active = False
+        bump_stat('active_doctors', -1)
+        bump_directory_version()
+        touch_schedule(doctor.id)
+        revoke_sessions('doctor', doctor.id)
     db.session.commit()
     flash('Doctor deactivated successfully', 'success')
     return redirect(url_for('admin_doctors'))
@@ -297,21 +3199,19 @@ def delete_doctor(id):
 def admin_patients():
     search = request.args.get('search', '')
     if search:
-        patients = Patient.query.filter(
-            (Patient.name.contains(search)) | 
-            (Patient.email.contains(search)) |
-            (Patient.phone.contains(search))
-        ).all()
+        page = KeysetPage(text_search(Patient.query, Patient, search, ['name', 'email', 'phone']).all())
     else:
-        patients = Patient.query.all()
-    
-    return render_template('admin_patients.html', patients=patients)
+        page = paginate_keyset(Patient.query, (Patient.id,))
+    return render_template('admin_patients.html', patients=page.items, page=page)
 
 @app.route('/admin/delete_patient/<int:id>')
 @login_required('admin')
 def delete_patient(id):
     patient = Patient.query.get_or_404(id)
-    patient.is_active = False
+    if patient.is_active:
+        patient.is_active = False
+        bump_stat('active_patients', -1)
+        revoke_sessions('patient', patient.id)
     db.session.commit()
     flash('Patient deactivated successfully', 'success')
     return redirect(url_for('admin_patients'))
@@ -319,23 +3219,76 @@ def delete_patient(id):
 @app.route('/admin/appointments')
 @login_required('admin')
 def admin_appointments():
-    appointments = Appointment.query.order_by(Appointment.date.desc(), Appointment.time.desc()).all()
-    return render_template('admin_appointments.html', appointments=appointments)
+    query = Appointment.query.options(with_patient(), with_doctor())
+    page = paginate_keyset(query, APPOINTMENT_ORDER)
+    return render_template('admin_appointments.html', appointments=page.items, page=page)
 
 @app.route('/admin/upcoming_appointments')
 @login_required('admin')
 def admin_upcoming_appointments():
     today = datetime.now().date()
     
-    # Get only future appointments with Booked status
-    appointments = Appointment.query.filter(
+    # Future appointments with Booked status, soonest first, one page at a time
+    query = Appointment.query.options(
+        with_patient(), with_doctor_department()
+    ).filter(
         Appointment.date >= today,
         Appointment.status == 'Booked'
-    ).order_by(Appointment.date.asc(), Appointment.time.asc()).all()
+    )
+    page = paginate_keyset(query, APPOINTMENT_ORDER, oldest_first=True)
     
     return render_template('admin_upcoming_appointments.html', 
-                         appointments=appointments, 
-                         today=today)  
+                         appointments=page.items, 
+                         page=page,
+                         total_upcoming=upcoming_booked_count(today),
+                         today=today,
+                         last_event_id=latest_event_id())
+
+@app.route('/admin/export/appointments.<fmt>')
+@login_required('admin')
+def export_appointments(fmt):
+    if fmt not in EXPORT_FORMATS:
+        flash('Unknown export format', 'danger')
+        return redirect(url_for('admin_appointments'))
+    try:
+        filters = parse_export_filters(request.args.get('start'), request.args.get('end'), request.args.get('status'))
+    except ValueError as e:
+        flash(f'Invalid export filter: {e}', 'danger')
+        return redirect(url_for('admin_appointments'))
+    
+    result = db.session.execute(export_statement(*filters))
+    response = Response(stream_with_context(export_chunks(result, fmt)), mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename=appointments.{fmt}'
+    return response
+
+@app.route('/admin/analytics')
+@login_required('admin')
+def admin_analytics():
+    today = datetime.now().date()
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if request.args.get('start') else today - timedelta(days=30)
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else today
+    except ValueError:
+        flash('Dates must be YYYY-MM-DD', 'danger')
+        return redirect(url_for('admin_analytics'))
+    if end < start:
+        start, end = end, start
+    
+    report = cached_utilization(start, end)
+    department_id = request.args.get('department_id', type=int)
+    doctors = report['doctors']
+    if department_id:
+        doctors = [d for d in doctors if d['department_id'] == department_id]
+    
+    return render_template('admin_analytics.html',
+                         report=report,
+                         doctors=doctors[:app.config['ANALYTICS_TOP_DOCTORS']],
+                         department_id=department_id)
+
+@app.route('/admin/cache_stats')
+@login_required('admin')
+def cache_stats():
+    return jsonify(reference_cache.stats())
 
 # ===================== DOCTOR ROUTES =====================
 
@@ -346,39 +3299,88 @@ def doctor_dashboard():
     today = datetime.now().date()
     week_later = today + timedelta(days=7)
     
-    # Get upcoming appointments for next 7 days
-    upcoming_appointments = Appointment.query.filter(
+    # Upcoming appointments for next 7 days; the table shows the first MAX_PAGE_SIZE of them
+    upcoming = Appointment.query.filter(
         Appointment.doctor_id == doctor_id,
         Appointment.date.between(today, week_later),
         Appointment.status == 'Booked'
-    ).order_by(Appointment.date, Appointment.time).all()
+    )
+    total_upcoming = upcoming.count()
+    upcoming_appointments = upcoming.options(with_patient()).order_by(
+        *APPOINTMENT_ORDER).limit(app.config['MAX_PAGE_SIZE']).all()
     
-    # Get list of unique patients assigned to this doctor
-    patients = db.session.query(Patient).join(Appointment).filter(
-        Appointment.doctor_id == doctor_id
-    ).distinct().all()
+    # Number of unique patients assigned to this doctor
+    total_patients, = get_stats(doctor_patients_stat(doctor_id))
     
-    total_patients = len(patients)
+    # The doctor's patients, most recently booked first
+    search = request.args.get('search', '')
+    roster = DoctorPatient.query.options(joinedload(DoctorPatient.patient)).filter(DoctorPatient.doctor_id == doctor_id)
+    if search:
+        page = KeysetPage(text_search(roster.join(Patient), Patient, search, ['name', 'email', 'phone']).all())
+    else:
+        page = paginate_keyset(roster, ROSTER_ORDER)
     
     return render_template('doctor_dashboard.html',
                          appointments=upcoming_appointments,
-                         patients=patients,
+                         total_upcoming=total_upcoming,
                          total_patients=total_patients,
-                         today=today)
+                         roster=page.items,
+                         page=page,
+                         today=today,
+                         week_later=week_later,
+                         last_event_id=latest_event_id())
 
 @app.route('/doctor/availability', methods=['GET', 'POST'])
 @login_required('doctor')
 def doctor_availability():
     doctor_id = session['user_id']
     
+    if request.method == 'POST' and request.form.get('kind') == 'weekly':
+        weekdays = [int(day) for day in request.form.getlist('weekdays') if day.isdigit() and int(day) < 7]
+        valid_from = request.form.get('valid_from')
+        valid_until = request.form.get('valid_until')
+        try:
+            start_time = datetime.strptime(request.form.get('start_time', ''), '%H:%M').time()
+            end_time = datetime.strptime(request.form.get('end_time', ''), '%H:%M').time()
+            valid_from = datetime.strptime(valid_from, '%Y-%m-%d').date() if valid_from else None
+            valid_until = datetime.strptime(valid_until, '%Y-%m-%d').date() if valid_until else None
+        except ValueError:
+            flash('Times must be HH:MM and dates YYYY-MM-DD', 'danger')
+            return redirect(url_for('doctor_availability'))
+        
+        if not weekdays or end_time <= start_time:
+            flash('Pick at least one weekday and an end time after the start time', 'danger')
+            return redirect(url_for('doctor_availability'))
+        
+        for weekday in weekdays:
+            db.session.add(AvailabilityRule(
+                doctor_id=doctor_id,
+                weekday=weekday,
+                start_time=start_time,
+                end_time=end_time,
+                valid_from=valid_from,
+                valid_until=valid_until
+            ))
+        touch_schedule(doctor_id)
+        db.session.commit()
+        flash('Weekly schedule updated successfully', 'success')
+        return redirect(url_for('doctor_availability'))
+    
     if request.method == 'POST':
-        date_str = request.form.get('date')
-        start_time_str = request.form.get('start_time')
-        end_time_str = request.form.get('end_time')
+        is_available = not request.form.get('day_off')
+        # A day off needs no times, so blank ones only default when it is ticked
+        default_time = '' if is_available else '00:00'
+        try:
+            date = datetime.strptime(request.form.get('date', ''), '%Y-%m-%d').date()
+            start_time = datetime.strptime(request.form.get('start_time') or default_time, '%H:%M').time()
+            end_time = datetime.strptime(request.form.get('end_time') or default_time, '%H:%M').time()
+        except ValueError:
+            flash('Pick a date and HH:MM start and end times, or mark the day off', 'danger')
+            return redirect(url_for('doctor_availability'))
         
-        date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        start_time = datetime.strptime(start_time_str, '%H:%M').time()
-        end_time = datetime.strptime(end_time_str, '%H:%M').time()
+        if is_available and end_time <= start_time:
+            flash('End time must be after the start time', 'danger')
+            return redirect(url_for('doctor_availability'))
         
         # Check if availability already exists
         existing = DoctorAvailability.query.filter_by(
@@ -389,38 +3391,67 @@ def doctor_availability():
         if existing:
             existing.start_time = start_time
             existing.end_time = end_time
-            existing.is_available = True
+            existing.is_available = is_available
         else:
             availability = DoctorAvailability(
                 doctor_id=doctor_id,
                 date=date,
                 start_time=start_time,
-                end_time=end_time
+                end_time=end_time,
+                is_available=is_available
             )
             db.session.add(availability)
         
+        touch_schedule(doctor_id)
         db.session.commit()
         flash('Availability updated successfully', 'success')
         return redirect(url_for('doctor_availability'))
     
-    # Get next 7 days availability
+    # Date overrides from today on
     today = datetime.now().date()
     availabilities = DoctorAvailability.query.filter(
         DoctorAvailability.doctor_id == doctor_id,
         DoctorAvailability.date >= today
     ).order_by(DoctorAvailability.date).all()
     
-    return render_template('doctor_availability.html', availabilities=availabilities)
+    rules = AvailabilityRule.query.filter_by(doctor_id=doctor_id).order_by(
+        AvailabilityRule.weekday, AvailabilityRule.start_time
+    ).all()
+    
+    # Effective schedule for the booking window, rules and overrides combined
+    start, end = booking_window(today)
+    windows = availability_windows([doctor_id], start, end)
+    schedule = [(day, sorted(windows[(doctor_id, day)])) for day in sorted(day for _, day in windows)]
+    
+    return render_template('doctor_availability.html',
+                         availabilities=availabilities,
+                         rules=rules,
+                         schedule=schedule,
+                         weekdays=WEEKDAYS)
+
+@app.route('/doctor/availability/rule/<int:id>/delete')
+@login_required('doctor')
+def delete_availability_rule(id):
+    rule = AvailabilityRule.query.get_or_404(id)
+    
+    if rule.doctor_id != session['user_id']:
+        flash('Unauthorized access', 'danger')
+        return redirect(url_for('doctor_availability'))
+    
+    db.session.delete(rule)
+    touch_schedule(rule.doctor_id)
+    db.session.commit()
+    flash('Weekly slot removed', 'success')
+    return redirect(url_for('doctor_availability'))
 
 @app.route('/doctor/appointments')
 @login_required('doctor')
 def doctor_appointments():
     doctor_id = session['user_id']
-    appointments = Appointment.query.filter_by(doctor_id=doctor_id).order_by(
-        Appointment.date.desc(), Appointment.time.desc()
-    ).all()
+    query = Appointment.query.options(with_patient()).filter_by(doctor_id=doctor_id)
+    page = paginate_keyset(query, APPOINTMENT_ORDER)
     
-    return render_template('doctor_appointments.html', appointments=appointments)
+    return render_template('doctor_appointments.html', appointments=page.items, page=page)
 
 @app.route('/doctor/complete_appointment/<int:id>', methods=['GET', 'POST'])
 @login_required('doctor')
@@ -461,6 +3492,7 @@ def complete_appointment(id):
             return redirect(url_for('complete_appointment', id=id))
         
         appointment.status = 'Completed'
+        bump_stat(booked_stat(appointment.date), -1)
         
         treatment = Treatment(
             appointment_id=appointment.id,
@@ -469,6 +3501,9 @@ def complete_appointment(id):
             notes=notes
         )
         db.session.add(treatment)
+        roster_completed(appointment.doctor_id, appointment.patient_id, appointment.date, diagnosis)
+        touch_schedule(appointment.doctor_id, appointment.patient_id)
+        appointment_event('completed', appointment)
         db.session.commit()
         
         flash('Appointment completed successfully', 'success')
@@ -482,12 +3517,16 @@ def complete_appointment(id):
 @login_required('doctor')
 def patient_history(patient_id):
     patient = Patient.query.get_or_404(patient_id)
-    appointments = Appointment.query.filter_by(
+    include_archive = request.args.get('archive') == '1'
+    visits = db.session.get(DoctorPatient, (session['user_id'], patient_id))
+    query = Appointment.query.options(with_treatment()).filter_by(
         patient_id=patient_id,
         status='Completed'
-    ).order_by(Appointment.date.desc()).all()
+    )
+    page = history_page(query, patient_id, include_archive)
     
-    return render_template('patient_history.html', patient=patient, appointments=appointments)
+    return render_template('patient_history.html', patient=patient, appointments=page.items,
+                         visits=visits, page=page, include_archive=include_archive)
 
 @app.route('/doctor/cancel_appointment/<int:id>')
 @login_required('doctor')
@@ -499,7 +3538,15 @@ def cancel_appointment_doctor(id):
         flash('Unauthorized access', 'danger')
         return redirect(url_for('doctor_dashboard'))
     
+    # Completed visits are already on the roster and finished ones can't be cancelled again
+    if appointment.status != 'Booked':
+        flash(f'This appointment is already {appointment.status}', 'warning')
+        return redirect(url_for('doctor_dashboard'))
+    
+    bump_stat(booked_stat(appointment.date), -1)
     appointment.status = 'Cancelled'
+    touch_schedule(appointment.doctor_id, appointment.patient_id)
+    appointment_event('cancelled', appointment)
     db.session.commit()
     
     flash('Appointment cancelled successfully', 'success')
@@ -510,10 +3557,10 @@ def cancel_appointment_doctor(id):
 @app.route('/patient/dashboard')
 @login_required('patient')
 def patient_dashboard():
-    departments = Department.query.all()
+    departments = cached_departments()
     patient_id = session['user_id']
     
-    upcoming_appointments = Appointment.query.filter(
+    upcoming_appointments = Appointment.query.options(with_doctor_department()).filter(
         Appointment.patient_id == patient_id,
         Appointment.date >= datetime.now().date(),
         Appointment.status == 'Booked'
@@ -529,24 +3576,33 @@ def patient_doctors():
     search = request.args.get('search', '')
     department_id = request.args.get('department_id', '')
     
-    query = Doctor.query.filter_by(is_active=True)
+    department_id = int(department_id) if department_id.isdigit() else None
     
     if search:
-        query = query.filter(Doctor.name.contains(search))
-    
-    if department_id:
-        query = query.filter_by(department_id=department_id)
-    
-    doctors = query.all()
-    departments = Department.query.all()
+        query = Doctor.query.options(joinedload(Doctor.department)).filter_by(is_active=True)
+        if department_id:
+            query = query.filter_by(department_id=department_id)
+        doctors = text_search(query, Doctor, search, ['name']).all()
+    else:
+        doctors = cached_doctors(department_id)
+    departments = cached_departments()
     
     # Get availability for next 7 days
-    today = datetime.now().date()
-    week_later = today + timedelta(days=7)
+    today, week_later = booking_window()
+    
+    # Earliest free slot in the selected department, across all its doctors
+    next_slot = None
+    if department_id:
+        first = first_free_slot(department_id, today, week_later)
+        if first:
+            doctor = next((d for d in cached_doctors(department_id) if d['id'] == first[2]), None)
+            if doctor:
+                next_slot = {'date': first[0], 'time': first[1], 'doctor': doctor}
     
     return render_template('patient_doctors.html',
                          doctors=doctors,
                          departments=departments,
+                         next_slot=next_slot,
                          today=today,
                          week_later=week_later)
 
@@ -556,46 +3612,43 @@ def book_appointment(doctor_id):
     doctor = Doctor.query.get_or_404(doctor_id)
     
     if request.method == 'POST':
-        date_str = request.form.get('date')
-        time_str = request.form.get('time')
+        # The form posts a single "slot" (YYYY-MM-DDTHH:MM); plain date + time still work
+        slot = request.form.get('slot')
+        if slot:
+            date_str, _, time_str = slot.partition('T')
+        else:
+            date_str = request.form.get('date')
+            time_str = request.form.get('time')
         
-        date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        time = datetime.strptime(time_str, '%H:%M').time()
+        try:
+            date = datetime.strptime(date_str, '%Y-%m-%d').date()
+            time = datetime.strptime(time_str, '%H:%M').time()
+        except (TypeError, ValueError):
+            flash('Please select a valid time slot', 'danger')
+            return redirect(url_for('book_appointment', doctor_id=doctor_id))
         
-        existing = Appointment.query.filter_by(
-            doctor_id=doctor_id,
-            date=date,
-            time=time,
-            status='Booked'
-        ).first()
+        today, last_day = booking_window()
+        if not today <= date <= last_day:
+            flash('Appointments can only be booked from today up to %s' % last_day.strftime('%Y-%m-%d'), 'danger')
+            return redirect(url_for('book_appointment', doctor_id=doctor_id))
         
-        if existing:
-            flash('This time slot is already booked', 'danger')
+        free = free_slots([doctor_id], date, date).get(doctor_id, {}).get(date, [])
+        if time not in free:
+            flash('This time slot is not available, please pick one of the free slots', 'danger')
             return redirect(url_for('book_appointment', doctor_id=doctor_id))
         
-        appointment = Appointment(
-            patient_id=session['user_id'],
-            doctor_id=doctor_id,
-            date=date,
-            time=time,
-            reason=request.form.get('reason')
-        )
-        db.session.add(appointment)
-        db.session.commit()
+        appointment = book_slot(session['user_id'], doctor_id, date, time, request.form.get('reason'))
+        if appointment is None:
+            flash('Sorry, this time slot was just booked by someone else. Please pick another one.', 'danger')
+            return redirect(url_for('book_appointment', doctor_id=doctor_id))
         
         flash('Appointment booked successfully', 'success')
         return redirect(url_for('patient_dashboard'))
     
-    today = datetime.now().date()
-    week_later = today + timedelta(days=7)
-    
-    availabilities = DoctorAvailability.query.filter(
-        DoctorAvailability.doctor_id == doctor_id,
-        DoctorAvailability.date.between(today, week_later),
-        DoctorAvailability.is_available == True
-    ).all()
+    today, week_later = booking_window()
+    slots = free_slots([doctor_id], today, week_later).get(doctor_id, {})
     
-    return render_template('book_appointment.html', doctor=doctor, availabilities=availabilities, today=today, week_later=week_later)
+    return render_template('book_appointment.html', doctor=doctor, slots=slots, today=today, week_later=week_later)
 
 @app.route('/patient/cancel_appointment/<int:id>')
 @login_required('patient')
@@ -606,7 +3659,14 @@ def cancel_appointment(id):
         flash('Unauthorized access', 'danger')
         return redirect(url_for('patient_dashboard'))
     
+    if appointment.status != 'Booked':
+        flash(f'This appointment is already {appointment.status}', 'warning')
+        return redirect(url_for('patient_appointments'))
+    
+    bump_stat(booked_stat(appointment.date), -1)
     appointment.status = 'Cancelled'
+    touch_schedule(appointment.doctor_id, appointment.patient_id)
+    appointment_event('cancelled', appointment)
     db.session.commit()
     
     flash('Appointment cancelled successfully', 'success')
@@ -616,22 +3676,26 @@ def cancel_appointment(id):
 @login_required('patient')
 def patient_appointments():
     patient_id = session['user_id']
-    appointments = Appointment.query.filter_by(patient_id=patient_id).order_by(
-        Appointment.date.desc(), Appointment.time.desc()
-    ).all()
+    query = Appointment.query.options(with_doctor_department()).filter_by(patient_id=patient_id)
+    page = paginate_keyset(query, APPOINTMENT_ORDER)
     
-    return render_template('patient_appointments.html', appointments=appointments)
+    return render_template('patient_appointments.html', appointments=page.items, page=page)
 
 @app.route('/patient/treatment_history')
 @login_required('patient')
 def treatment_history():
     patient_id = session['user_id']
-    appointments = Appointment.query.filter_by(
+    include_archive = request.args.get('archive') == '1'
+    query = Appointment.query.options(
+        with_doctor_department(), with_treatment()
+    ).filter_by(
         patient_id=patient_id,
         status='Completed'
-    ).order_by(Appointment.date.desc()).all()
+    )
+    page = history_page(query, patient_id, include_archive)
     
-    return render_template('treatment_history.html', appointments=appointments)
+    return render_template('treatment_history.html', appointments=page.items, page=page,
+                         include_archive=include_archive)
 
 @app.route('/patient/profile', methods=['GET', 'POST'])
 @login_required('patient')
@@ -644,6 +3708,10 @@ def patient_profile():
         patient.age = request.form.get('age')
         patient.gender = request.form.get('gender')
         patient.address = request.form.get('address')
+        sessions_changed('patient', patient.id)
+        # The doctors' appointment feeds carry the patient's name
+        for doctor_id, in db.session.query(Appointment.doctor_id).filter_by(patient_id=patient.id).distinct():
+            touch_schedule(doctor_id)
         
         db.session.commit()
         flash('Profile updated successfully', 'success')
@@ -651,8 +3719,362 @@ def patient_profile():
     
     return render_template('patient_profile.html', patient=patient)
 
+# ===================== JSON API =====================
+
+# /api/v1 serves the data behind the portal pages to kiosks and the mobile app, using the
+# same login session. Every response carries an ETag built from a change counter, and a
+# poll whose If-None-Match (or If-Modified-Since) still matches gets 304 after a single
+# cache_version read, before any appointment, slot or directory query runs.
+
+app.json.compact = True
+app.json.sort_keys = False
+
+def api_error(message, status):
+    return jsonify(error=message), status
+
+def api_date(name, default=None):
+    value = request.args.get(name)
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else default
+
+def query_tag():
+    # Filters and page cursors are part of what a response holds, so part of its tag
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return hashlib.sha1(query.encode()).hexdigest()[:12]
+
+def conditional_json(etag, last_modified, build):
+    etag = f'v1-{etag}'
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = (last_modified is not None and request.if_modified_since is not None
+                        and last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since)
+    response = Response(status=304) if not_modified else jsonify(build())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+def appointment_json(appointment, doctor=False, patient=False):
+    item = {
+        'id': appointment.id,
+        'doctor_id': appointment.doctor_id,
+        'patient_id': appointment.patient_id,
+        'date': appointment.date.isoformat(),
+        'time': appointment.time.strftime('%H:%M'),
+        'status': appointment.status,
+        'reason': appointment.reason,
+    }
+    if doctor:
+        item['doctor'] = appointment.doctor.name
+    if patient:
+        item['patient'] = appointment.patient.name
+    return item
+
+def appointments_response(owner_column, owner_id, version_name, doctor=False, patient=False):
+    try:
+        start, end = api_date('from'), api_date('to')
+    except ValueError:
+        return api_error('from and to must be YYYY-MM-DD', 400)
+    status = request.args.get('status')
+    version, updated_at = change_version(version_name)
+    etag = f'{version_name}-{version}'
+    if doctor:
+        # Doctor names come from the directory, which edit_doctor bumps
+        directory, directory_updated_at = change_version('directory')
+        etag += f'-directory-{directory}'
+        if updated_at is None or (directory_updated_at is not None and directory_updated_at > updated_at):
+            updated_at = directory_updated_at
+
+    def build():
+        query = Appointment.query.filter(owner_column == owner_id)
+        if doctor:
+            query = query.options(with_doctor())
+        if patient:
+            query = query.options(with_patient())
+        if status:
+            query = query.filter(Appointment.status == status)
+        if start:
+            query = query.filter(Appointment.date >= start)
+        if end:
+            query = query.filter(Appointment.date <= end)
+        page = paginate_keyset(query, APPOINTMENT_ORDER)
+        return {
+            'appointments': [appointment_json(a, doctor=doctor, patient=patient) for a in page.items],
+            'next': page.next_url,
+            'prev': page.prev_url,
+        }
+    return conditional_json(f'{etag}-{query_tag()}', updated_at, build)
+
+def schedule_range():
+    start, end = booking_window()
+    return api_date('start', start), api_date('end', end)
+
+@app.route('/api/v1/departments')
+@api_login_required('admin', 'doctor', 'patient')
+def api_departments():
+    version, updated_at = change_version('directory')
+    g.directory_version = version
+    return conditional_json(f'directory-{version}', updated_at, lambda: {'departments': cached_departments()})
+
+@app.route('/api/v1/doctors')
+@api_login_required('admin', 'doctor', 'patient')
+def api_doctors():
+    department_id = request.args.get('department_id', type=int)
+    version, updated_at = change_version('directory')
+    g.directory_version = version
+    return conditional_json(f'directory-{version}', updated_at, lambda: {'doctors': cached_doctors(department_id)})
+
+@app.route('/api/v1/doctors/<int:doctor_id>/availability')
+@api_login_required('admin', 'doctor', 'patient')
+def api_doctor_availability(doctor_id):
+    try:
+        start, end = schedule_range()
+    except ValueError:
+        return api_error('start and end must be YYYY-MM-DD', 400)
+    version, _ = change_version(doctor_version_name(doctor_id))
+
+    def build():
+        windows = availability_windows([doctor_id], start, end)
+        return {'doctor_id': doctor_id, 'days': {
+            day.isoformat(): [[s.strftime('%H:%M'), e.strftime('%H:%M')] for s, e in sorted(windows[(doctor_id, day)])]
+            for day in sorted(day for _, day in windows)
+        }}
+    return conditional_json(f'doctor:{doctor_id}-{version}-{start}-{end}', None, build)
+
+@app.route('/api/v1/doctors/<int:doctor_id>/free_slots')
+@api_login_required('admin', 'doctor', 'patient')
+def api_free_slots(doctor_id):
+    try:
+        start, end = schedule_range()
+    except ValueError:
+        return api_error('start and end must be YYYY-MM-DD', 400)
+    version, _ = change_version(doctor_version_name(doctor_id))
+    # Today's slots drop out as they start, so the tag also moves with the current slot
+    now = datetime.now()
+    started = slot_index(now.time()) if start <= now.date() <= end else ''
+
+    def build():
+        days = free_slots([doctor_id], start, end).get(doctor_id, {})
+        return {'doctor_id': doctor_id, 'days': {
+            day.isoformat(): [t.strftime('%H:%M') for t in times] for day, times in days.items()
+        }}
+    return conditional_json(f'doctor:{doctor_id}-{version}-{start}-{end}-{started}', None, build)
+
+@app.route('/api/v1/doctors/<int:doctor_id>/appointments')
+@api_login_required('admin', 'doctor')
+def api_doctor_appointments(doctor_id):
+    if session['role'] == 'doctor' and session['user_id'] != doctor_id:
+        return api_error('forbidden', 403)
+    return appointments_response(Appointment.doctor_id, doctor_id, doctor_version_name(doctor_id), patient=True)
+
+@app.route('/api/v1/patients/<int:patient_id>/appointments')
+@api_login_required('admin', 'patient')
+def api_patient_appointments(patient_id):
+    if session['role'] == 'patient' and session['user_id'] != patient_id:
+        return api_error('forbidden', 403)
+    return appointments_response(Appointment.patient_id, patient_id, patient_version_name(patient_id), doctor=True)
+
+# ===================== LIVE APPOINTMENT EVENTS =====================
+
+# The doctor dashboard and the admin upcoming list patch themselves from a Server-Sent Events
+# stream instead of being reloaded. Booking, cancelling and completing write an
+# appointment_event row in the same transaction. The table is also the broker between
+# workers: each process runs one broker thread, only while it has subscribers, that reads
+# new rows every EVENT_POLL_SECONDS and fans them out to that process's streams, and is woken
+# at once when its own process commits an event. Admins get every event, a doctor only theirs.
+# Event ids double as SSE ids, so a reconnecting EventSource (Last-Event-ID) or a page that
+# passes ?after=<id it was rendered at> first gets what it missed from the table. Streams
+# are closed after EVENT_STREAM_SECONDS, or when a client falls EVENT_QUEUE_SIZE events
+# behind, and the browser reconnects. Each stream holds a worker thread, so at most
+# EVENT_MAX_STREAMS run per process, by default two fewer than gunicorn's GUNICORN_THREADS
+# so open boards can never take every thread and stall logins and bookings.
+
+app.config['EVENT_POLL_SECONDS'] = float(os.environ.get('EVENT_POLL_SECONDS', 1))
+app.config['EVENT_KEEPALIVE_SECONDS'] = 15
+app.config['EVENT_STREAM_SECONDS'] = int(os.environ.get('EVENT_STREAM_SECONDS', 300))
+app.config['EVENT_MAX_STREAMS'] = int(os.environ.get('EVENT_MAX_STREAMS',
+                                                   max(1, int(os.environ.get('GUNICORN_THREADS', 8)) - 2)))
+app.config['EVENT_QUEUE_SIZE'] = 100
+app.config['EVENT_REPLAY_LIMIT'] = 500
+app.config['EVENT_RETENTION_HOURS'] = 24
+
+def appointment_event(kind, appointment):
+    patient, doctor, department = db.session.query(Patient, Doctor, Department).select_from(Appointment).join(
+        Patient, Patient.id == Appointment.patient_id).join(Doctor, Doctor.id == Appointment.doctor_id).join(
+        Department, Department.id == Doctor.department_id).filter(Appointment.id == appointment.id).one()
+    payload = {
+        'kind': kind, 'appointment_id': appointment.id, 'doctor_id': doctor.id, 'patient_id': patient.id,
+        'date': appointment.date.isoformat(), 'time': appointment.time.strftime('%H:%M'),
+        'weekday': appointment.date.strftime('%A'), 'time_label': appointment.time.strftime('%I:%M %p'),
+        'patient_name': patient.name, 'patient_email': patient.email, 'patient_phone': patient.phone,
+        'doctor_name': doctor.name, 'doctor_phone': doctor.phone, 'department': department.name,
+        'created_at': (appointment.created_at or datetime.utcnow()).strftime('%Y-%m-%d %H:%M'),
+    }
+    db.session.add(AppointmentEvent(doctor_id=doctor.id, kind=kind, payload=json.dumps(payload)))
+    db.session.info['appointment_events'] = True
+
+@event.listens_for(Session, 'after_commit')
+def wake_event_broker(db_session):
+    if db_session.info.pop('appointment_events', False):
+        event_broker.wake.set()
+
+@event.listens_for(Session, 'after_rollback')
+def forget_appointment_events(db_session):
+    db_session.info.pop('appointment_events', None)
+
+def event_message(row):
+    return dict(json.loads(row.payload), id=row.id)
+
+def latest_event_id():
+    return db.session.query(func.max(AppointmentEvent.id)).scalar() or 0
+
+def missed_events(after, doctor_id=None):
+    query = AppointmentEvent.query.filter(AppointmentEvent.id > after)
+    if doctor_id is not None:
+        query = query.filter(AppointmentEvent.doctor_id == doctor_id)
+    return [event_message(row) for row in query.order_by(AppointmentEvent.id).limit(app.config['EVENT_REPLAY_LIMIT'])]
+
+class EventBroker:
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.last_id = None
+        self.thread = None
+
+    def subscribe(self, channel):
+        subscriber = queue.Queue(maxsize=app.config['EVENT_QUEUE_SIZE'])
+        subscriber.overflowed = False
+        with self.lock:
+            if self.last_id is None:
+                self.last_id = latest_event_id()
+            self.channels.setdefault(channel, set()).add(subscriber)
+            # Started on first use, never in the gunicorn master
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='event-broker', daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, channel, subscriber):
+        with self.lock:
+            subscribers = self.channels.get(channel, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self.channels.pop(channel, None)
+
+    def publish(self, message):
+        with self.lock:
+            subscribers = list(self.channels.get('admin', ())) + list(
+                self.channels.get(f"doctor:{message['doctor_id']}", ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                subscriber.overflowed = True
+
+    def run(self):
+        while True:
+            self.wake.wait(app.config['EVENT_POLL_SECONDS'])
+            self.wake.clear()
+            with self.lock:
+                if not self.channels:
+                    # Nobody listening; the next subscriber starts from the newest event
+                    self.last_id = None
+                    continue
+                after = self.last_id
+            try:
+                with app.app_context():
+                    rows = AppointmentEvent.query.filter(AppointmentEvent.id > after).order_by(
+                        AppointmentEvent.id).limit(app.config['EVENT_REPLAY_LIMIT']).all()
+                    messages = [event_message(row) for row in rows]
+            except Exception:
+                app.logger.exception('Reading appointment events failed')
+                continue
+            for message in messages:
+                self.publish(message)
+            with self.lock:
+                if messages and self.last_id is not None:
+                    self.last_id = max(self.last_id, messages[-1]['id'])
+            if len(messages) == app.config['EVENT_REPLAY_LIMIT']:
+                self.wake.set()
+
+event_broker = EventBroker()
+event_streams = threading.BoundedSemaphore(app.config['EVENT_MAX_STREAMS'])
+
+def sse(message):
+    return f"id: {message['id']}\nevent: appointment\ndata: {json.dumps(message)}\n\n"
+
+def event_stream(channel, doctor_id, after):
+    subscriber = event_broker.subscribe(channel)
+    try:
+        missed = missed_events(after, doctor_id) if after is not None else []
+        # The login check already used the session: don't hold its connection (and a read
+        # transaction that blocks WAL checkpoints) for the life of the stream
+        db.session.remove()
+        yield f"retry: {app.config['EVENT_KEEPALIVE_SECONDS'] * 1000 // 3}\n\n"
+        sent = after if after is not None else event_broker.last_id or 0
+        for message in missed:
+            yield sse(message)
+            sent = message['id']
+        deadline = clock.monotonic() + app.config['EVENT_STREAM_SECONDS']
+        while clock.monotonic() < deadline and not subscriber.overflowed:
+            try:
+                message = subscriber.get(timeout=app.config['EVENT_KEEPALIVE_SECONDS'])
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if message['id'] > sent:
+                yield sse(message)
+                sent = message['id']
+    finally:
+        event_broker.unsubscribe(channel, subscriber)
+
+@app.route('/events/appointments')
+@api_login_required('admin', 'doctor')
+def appointment_events():
+    after = request.headers.get('Last-Event-ID') or request.args.get('after')
+    after = int(after) if after and after.isdigit() else None
+    if not event_streams.acquire(blocking=False):
+        return jsonify(error='too many live boards open, try again later'), 503, {'Retry-After': '30'}
+    if session['role'] == 'admin':
+        channel, doctor_id = 'admin', None
+    else:
+        channel, doctor_id = f"doctor:{session['user_id']}", session['user_id']
+    response = Response(stream_with_context(event_stream(channel, doctor_id, after)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(event_streams.release)
+    return response
+
+# ===================== STARTUP CHECK =====================
+
+# Production entry point, used by wsgi.py under gunicorn (see gunicorn.conf.py). This is not
+# an application factory: routes, hooks and the database are set up on the module-level app
+# at import time, so configure it through the environment (DATABASE_URL, JINJA_CACHE_DIR,
+# INSTRUMENT_REQUESTS, ...). prepare_app() only checks the schema, wires up logging and hands
+# back that same app. It never creates tables or seeds rows: run `flask --app app init-db`
+# once per deploy, then any number of workers can start together without racing on
+# create_all or the admin row.
+
+def prepare_app():
+    with app.app_context():
+        try:
+            version = check_schema()
+        finally:
+            # With --preload this runs in the gunicorn master; don't hand its connections to the workers
+            db.engine.dispose()
+
+    server_log = logging.getLogger('gunicorn.error')
+    if server_log.handlers:
+        app.logger.handlers = server_log.handlers
+        app.logger.setLevel(server_log.level)
+    app.logger.info('App ready in %.0f ms (schema version %s)', (clock.perf_counter() - STARTED) * 1000, version)
+    return app
+
 # ===================== RUN APP =====================
 
+# Development server with the debugger and reloader; see README "Production" for gunicorn
 if __name__ == '__main__':
     init_db()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,25 @@
+# gunicorn -c gunicorn.conf.py wsgi:app
+# Run `flask --app app init-db` first; workers only check the schema, they never create it.
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Threads (gthread workers) so the live boards' event streams don't each hold a whole worker.
+# The app caps streams at two fewer than this (EVENT_MAX_STREAMS), so keep them in step.
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Import the app once in the master and fork the workers from it, so they start in
+# milliseconds and share the imported code pages
+preload_app = True
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so per-process caches and any leaks stay bounded
+max_requests = 5000
+max_requests_jitter = 500
+
+accesslog = os.environ.get('ACCESS_LOG', '-')
+loglevel = os.environ.get('LOG_LEVEL', 'info')
@@ -0,0 +1,85 @@
+// Keeps an appointment table current from the /events/appointments stream instead of
+// reloading the page. The table carries data-live-board (stream URL) and data-last-event
+// (newest event when the page was rendered); new rows are cloned from <template id="live-row">.
+// Optional data-from / data-until bound the dates the board covers, and on a page with more
+// rows after it data-page-end is the last row's sort key: later bookings only change the
+// data-live-count total, they belong on the next page.
+(function () {
+    const board = document.querySelector('[data-live-board]');
+    if (!board || !window.EventSource) {
+        return;
+    }
+    const rows = board.querySelector('tbody');
+    const template = document.getElementById('live-row');
+    const from = board.dataset.from;
+    const until = board.dataset.until;
+    const pageEnd = board.dataset.pageEnd;
+
+    function findRow(id) {
+        return rows.querySelector('tr[data-appointment-id="' + id + '"]');
+    }
+
+    function covers(appointment) {
+        return (!from || appointment.date >= from) && (!until || appointment.date <= until);
+    }
+
+    function changeCount(delta) {
+        document.querySelectorAll('[data-live-count]').forEach(function (el) {
+            el.textContent = Math.max(0, parseInt(el.textContent, 10) + delta);
+        });
+    }
+
+    function refreshEmpty() {
+        const shown = rows.querySelectorAll('tr[data-appointment-id]').length;
+        document.querySelectorAll('[data-live-empty]').forEach(function (el) { el.classList.toggle('d-none', shown > 0); });
+        board.classList.toggle('d-none', shown === 0);
+    }
+
+    function addRow(appointment) {
+        const sort = appointment.date + 'T' + appointment.time;
+        if (pageEnd && sort > pageEnd) {
+            return;
+        }
+        const row = template.content.firstElementChild.cloneNode(true);
+        row.dataset.appointmentId = appointment.appointment_id;
+        row.dataset.sort = sort;
+        row.querySelectorAll('[data-field]').forEach(function (el) {
+            el.textContent = appointment[el.dataset.field] || '';
+        });
+        // Links are rendered for id 0 and pointed at the real record here
+        row.querySelectorAll('[data-href]').forEach(function (el) {
+            el.href = el.dataset.href.replace(/0$/, appointment[el.dataset.hrefField || 'appointment_id']);
+        });
+        const next = Array.prototype.find.call(rows.querySelectorAll('tr[data-sort]'), function (other) {
+            return other.dataset.sort > row.dataset.sort;
+        });
+        rows.insertBefore(row, next || null);
+        row.classList.add('table-success');
+    }
+
+    const source = new EventSource(board.dataset.liveBoard + '?after=' + board.dataset.lastEvent);
+    source.addEventListener('appointment', function (message) {
+        const appointment = JSON.parse(message.data);
+        const row = findRow(appointment.appointment_id);
+        // Every other kind (cancelled, completed, ...) ends a booking the total included
+        if (!covers(appointment) || (appointment.kind === 'booked' && row)) {
+            return;
+        }
+        if (appointment.kind === 'booked') {
+            addRow(appointment);
+            changeCount(1);
+        } else {
+            if (row) {
+                row.remove();
+            }
+            changeCount(-1);
+        }
+        refreshEmpty();
+    });
+    source.onerror = function () {
+        // The server turned us away (e.g. too many boards open): fall back to reloading
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(function () { location.reload(); }, 30000);
+        }
+    };
+})();
@@ -0,0 +1,3 @@
+from app import prepare_app
+
+app = prepare_app()